@@ -13,10 +13,13 @@ Usage:
 Requirements: pip install requests gradio
 """
 
-import requests, json, time, threading, sys, signal, re
+import requests, json, time, threading, sys, signal, re, random, hashlib, os, queue, gzip, shutil, atexit, weakref, math
+import sqlite3
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from pathlib import Path
-from collections import deque
 
 # ═══════════════════════════════════════════════════════════════════
 # シード
@@ -53,6 +56,2139 @@ TOOL_DEFINITIONS = """【使用可能なツール】
 ツールを使いたいと思ったら、思考の中で自然に使ってよい。躊躇せず。
 """
 
+# 形式1: [TOOL:name:content]
+TOOL_PATTERN = re.compile(r'\[TOOL:(\w+):([^\]]+)\]')
+# 形式2: <tool_call>{"name": "xxx", "arguments": {...}}</tool_call>
+TOOL_CALL_PATTERN = re.compile(r'<tool_call>\s*(\{.*?\})\s*</tool_call>', re.DOTALL)
+# 実装のあるツール（メトリクスのラベルはこれ以外を other にまとめる）
+TOOL_NAMES = ("search", "message", "remember", "feel")
+
+
+class ToolScanner:
+    """ストリーム中のツール呼び出し検出 — 完結したスパンだけを逐次返す"""
+    OPENERS = ("[TOOL:", "<tool_call>")
+
+    def __init__(self):
+        self.text = ""
+        self.spans = []
+        self._pos = 0  # ここより前は走査済み（未完結の開始記号を含まない）
+
+    def feed(self, delta):
+        self.text += delta
+        found = []
+        while True:
+            m1 = TOOL_PATTERN.search(self.text, self._pos)
+            m2 = TOOL_CALL_PATTERN.search(self.text, self._pos)
+            m = min((m for m in (m1, m2) if m), key=lambda m: m.start(), default=None)
+            if not m:
+                break
+            found.append(m)
+            self._pos = m.end()
+        if not found:
+            # 開始記号が現れていなければ、途中で切れた記号の分だけ残して先へ進める
+            tail = self.text[self._pos:]
+            if not any(o in tail for o in self.OPENERS):
+                self._pos = max(self._pos, len(self.text) - len(self.OPENERS[1]))
+        self.spans.extend(found)
+        return found
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 通信
+# ═══════════════════════════════════════════════════════════════════
+
+class CircuitOpen(requests.RequestException):
+    """サーキットブレーカー開放中 — retry_after 秒後まで送信しない"""
+    def __init__(self, retry_after):
+        super().__init__(f"circuit open ({retry_after:.1f}s)")
+        self.retry_after = retry_after
+
+
+class _TransportBase:
+    """再試行・バックオフ・サーキットブレーカーと統計"""
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    GEN_PATHS = ("/v1/completions", "/v1/chat/completions")
+
+    def __init__(self, base_url, connect_timeout=5.0, read_timeout=300.0, retries=3,
+                 backoff_base=0.5, backoff_max=30.0, breaker_threshold=5, breaker_cooldown=30.0,
+                 pool_size=4):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._failures = 0       # 連続失敗数
+        self._open_until = 0.0   # ブレーカー開放期限（monotonic）
+        self.stats = {"requests": 0, "opened": 0, "retries": 0, "failures": 0, "rejected": 0}
+
+    def backoff(self, attempt):
+        """full jitter 指数バックオフ"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def retry_after(self):
+        """次の送信まで待つべき秒数（ブレーカー開放中なら残り時間、連続失敗中ならバックオフ）"""
+        remaining = self._open_until - time.monotonic()
+        if remaining > 0:
+            return remaining
+        return self.backoff(self._failures) if self._failures else 0.0
+
+    def breaker_state(self):
+        if self._failures < self.breaker_threshold:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half-open"
+
+    def _admit(self):
+        with self._lock:
+            remaining = self._open_until - time.monotonic()
+            if remaining > 0:
+                self.stats["rejected"] += 1
+                raise CircuitOpen(remaining)
+            self.stats["requests"] += 1
+
+    def _record(self, ok):
+        with self._lock:
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            self.stats["failures"] += 1
+            if self._failures >= self.breaker_threshold:
+                # half-open で 1 回試し、失敗すれば再び開放
+                self._open_until = time.monotonic() + self.breaker_cooldown
+
+    def _count_conn(self):
+        with self._lock:
+            self.stats["opened"] += 1
+
+    def connection_stats(self):
+        s = dict(self.stats)
+        s["reused"] = max(0, s["requests"] - s["opened"])
+        s["breaker"] = self.breaker_state()
+        return s
+
+
+class _CountingAdapter(HTTPAdapter):
+    """新規 TCP 接続の生成を数えるアダプタ"""
+
+    def __init__(self, on_new_conn, **kw):
+        self._on_new_conn = on_new_conn
+        super().__init__(**kw)
+
+    def init_poolmanager(self, *args, **kw):
+        super().init_poolmanager(*args, **kw)
+        on_new_conn = self._on_new_conn
+
+        def counting(base):
+            class Pool(base):
+                def _new_conn(self):
+                    on_new_conn()
+                    return super()._new_conn()
+            return Pool
+
+        pm = self.poolmanager
+        pm.pool_classes_by_scheme = {k: counting(v) for k, v in pm.pool_classes_by_scheme.items()}
+
+
+class Transport(_TransportBase):
+    """keep-alive 接続プール付き HTTP 層（requests.Session）"""
+
+    def __init__(self, base_url, **kw):
+        super().__init__(base_url, **kw)
+        self.session = requests.Session()
+        adapter = _CountingAdapter(self._count_conn, pool_connections=1,
+                                   pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, payload=None, stream=False, read_timeout=None, retries=None):
+        """送信 — 接続失敗・タイムアウト・5xx は指数バックオフで再試行。4xx はそのまま例外
+
+        生成の読み取りタイムアウトは再試行しない（固まったサーバーに read_timeout ずつ何度も待たない）。
+        """
+        retries = self.retries if retries is None else retries
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        attempt = 0
+        while True:
+            self._admit()
+            try:
+                r = self.session.request(method, f"{self.base_url}{path}", json=payload,
+                                         stream=stream, timeout=timeout)
+                if r.status_code in self.RETRY_STATUS:
+                    r.close()
+                    raise requests.HTTPError(f"{r.status_code} {r.reason}", response=r)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                self._record(False)
+                if attempt >= retries or (isinstance(e, requests.ReadTimeout) and path in self.GEN_PATHS):
+                    raise
+                self.stats["retries"] += 1
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self._record(True)
+            r.raise_for_status()
+            return r
+
+    def get(self, path, **kw):
+        return self.request("GET", path, **kw)
+
+    def post(self, path, payload, **kw):
+        return self.request("POST", path, payload, **kw)
+
+    def close(self):
+        self.session.close()
+
+
+class Backend:
+    """プール内の 1 サーバー — 健康状態・EWMA 遅延・処理中の数"""
+    __slots__ = ("url", "model", "pinned", "transport", "healthy", "ewma", "outstanding", "last_error", "served")
+
+    def __init__(self, url, model=None, **transport_opts):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.pinned = model is not None  # 設定でモデルを指定したか（なければ /v1/models の先頭）
+        self.transport = Transport(self.url, **transport_opts)
+        self.healthy = True
+        self.ewma = None
+        self.outstanding = 0
+        self.last_error = None
+        self.served = 0
+
+    def score(self):
+        return (self.ewma or 0.0) * (self.outstanding + 1)
+
+
+class TransportPool:
+    """複数バックエンドへの振り分けとフェイルオーバー（Transport と同じ呼び出し方）
+
+    生成は 1 つのバックエンドに固定して送り続ける（思考の列がプロンプト先頭の KV キャッシュ・id_slot を
+    使い回せるように）。固定先が失敗するかブレーカーが開いたときだけ別のバックエンドへ移り、以後はそこに固定する。
+    それ以外の要求は健康なものから「EWMA 遅延 ×（処理中 + 1）」が最小のものへ。失敗したら不健康の印をつけて
+    次へ回す（4xx はリクエスト側の問題なのでそのまま例外）。裏のスレッドが probe_interval ごとに
+    /v1/models を叩いて復帰とモデル名を確認する。モデル名はバックエンドごとに payload へ入れ直す。
+    """
+    RETRY_STATUS = _TransportBase.RETRY_STATUS
+    GEN_PATHS = _TransportBase.GEN_PATHS
+
+    def __init__(self, backends, probe_interval=10.0, alpha=0.3, **transport_opts):
+        self.retries = transport_opts.get("retries", 3)
+        per_backend = dict(transport_opts, retries=0)  # 再試行は別のバックエンドで
+        self.backends = [Backend(b, **per_backend) if isinstance(b, str)
+                         else Backend(b["url"], b.get("model"), **per_backend) for b in backends]
+        self.base_url = self.backends[0].url
+        self.probe_interval = probe_interval
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._prober = None
+        self._stop = threading.Event()
+        self._sticky = None  # 生成の固定先
+        self.failovers = 0
+
+    # ─── 振り分け ───
+
+    def _ranked(self, sticky=False):
+        """試す順。sticky（生成）なら固定先を先頭に（固定先が使えなければ最良のものに固定し直す）"""
+        with self._lock:
+            healthy = sorted((b for b in self.backends if b.healthy), key=Backend.score)
+            order = healthy + [b for b in self.backends if not b.healthy]  # 全滅なら不健康なものも試す
+            if sticky:
+                b = self._sticky
+                if b is None or not b.healthy or b.transport.breaker_state() == "open":
+                    # 同点（未計測のうちは全部 0）はランダムに — 複数の mind が先頭の 1 台に集まらない
+                    tied = [x for x in healthy if x.score() == healthy[0].score()] or order[:1]
+                    b = self._sticky = random.choice(tied)
+                order.remove(b)
+                order.insert(0, b)
+        return order
+
+    def _mark_down(self, b, e):
+        b.healthy = False
+        b.last_error = str(e)[:200]
+        self.failovers += 1
+        with self._lock:
+            if self._sticky is b:
+                self._sticky = None
+
+    def request(self, method, path, payload=None, stream=False, read_timeout=None, retries=None):
+        retries = self.retries if retries is None else retries
+        sticky = path in self.GEN_PATHS
+        last = None
+        for attempt in range(retries + 1):
+            for b in self._ranked(sticky):
+                body = payload
+                if b.model and isinstance(payload, dict) and "model" in payload:
+                    body = dict(payload, model=b.model)
+                with self._lock:
+                    b.outstanding += 1
+                t0 = time.monotonic()
+                try:
+                    r = b.transport.request(method, path, body, stream=stream,
+                                            read_timeout=read_timeout, retries=0)
+                except requests.HTTPError as e:
+                    if e.response is not None and e.response.status_code not in self.RETRY_STATUS:
+                        raise
+                    last = e
+                    self._mark_down(b, e)
+                    continue
+                except requests.RequestException as e:
+                    last = e
+                    self._mark_down(b, e)
+                    if sticky and isinstance(e, requests.ReadTimeout):
+                        raise  # 生成の読み取りタイムアウトは送り直さない（次の思考は別のバックエンドへ）
+                    continue
+                finally:
+                    with self._lock:
+                        b.outstanding -= 1
+                b.healthy = True
+                b.served += 1
+                if sticky:  # ストリームなら最初の応答までの時間
+                    dt = time.monotonic() - t0
+                    b.ewma = dt if b.ewma is None else (1 - self.alpha) * b.ewma + self.alpha * dt
+                    with self._lock:
+                        self._sticky = b  # フェイルオーバー先に移ったらそこに固定
+                return r
+            if attempt < retries:
+                time.sleep(self.backoff(attempt))
+        raise last
+
+    def get(self, path, **kw):
+        return self.request("GET", path, **kw)
+
+    def post(self, path, payload, **kw):
+        return self.request("POST", path, payload, **kw)
+
+    # ─── 死活監視 ───
+
+    def probe(self):
+        """全バックエンドの /v1/models を確認。健康な数を返す"""
+        for b in self.backends:
+            try:
+                data = b.transport.get("/v1/models", read_timeout=5, retries=0).json()
+                if not data.get("data"):
+                    raise requests.RequestException("モデル未ロード")
+                if not b.pinned:
+                    b.model = data["data"][0]["id"]
+                b.healthy = True
+            except (requests.RequestException, ValueError) as e:
+                b.healthy = False
+                b.last_error = str(e)[:200]
+        return sum(b.healthy for b in self.backends)
+
+    def start_probing(self):
+        if self._prober and self._prober.is_alive():
+            return
+        self._stop.clear()
+        def run():
+            while not self._stop.wait(self.probe_interval):
+                self.probe()
+        self._prober = threading.Thread(target=run, daemon=True)
+        self._prober.start()
+
+    def primary_model(self):
+        """生成の固定先のモデル名"""
+        for b in self._ranked(sticky=True):
+            if b.model:
+                return b.model
+        return None
+
+    # ─── Transport 互換 ───
+
+    def backoff(self, attempt):
+        return self.backends[0].transport.backoff(attempt)
+
+    def retry_after(self):
+        """健康なバックエンドがあれば待たない"""
+        if any(b.healthy and b.transport.retry_after() == 0 for b in self.backends):
+            return 0.0
+        return min(b.transport.retry_after() for b in self.backends)
+
+    def connection_stats(self):
+        per = [dict(b.transport.connection_stats(), url=b.url, model=b.model, healthy=b.healthy,
+                    ewma=round(b.ewma, 3) if b.ewma is not None else None, outstanding=b.outstanding,
+                    served=b.served, error=b.last_error) for b in self.backends]
+        total = {k: sum(p[k] for p in per) for k in ("requests", "opened", "retries", "failures", "rejected", "reused")}
+        return dict(total, failovers=self.failovers, backends=per)
+
+    def close(self, timeout=10):
+        self._stop.set()
+        if self._prober and self._prober.is_alive():
+            self._prober.join(timeout)
+        for b in self.backends:
+            b.transport.close()
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 記録と再生（カセット）
+# ═══════════════════════════════════════════════════════════════════
+
+GEN_PATHS = TransportPool.GEN_PATHS
+# ストリームの1チャンクから差分テキストを取り出す（パスごと）
+SSE_PICK = {"/v1/completions": lambda ch: ch.get("text"),
+            "/v1/chat/completions": lambda ch: (ch.get("delta") or {}).get("content")}
+
+
+def prompt_text(payload):
+    """キーにする本文 — prompt / messages / content（tokenize）"""
+    if not isinstance(payload, dict):
+        return ""
+    if "prompt" in payload:
+        return str(payload["prompt"])
+    if "messages" in payload:
+        return json.dumps(payload["messages"], ensure_ascii=False, sort_keys=True)
+    return str(payload.get("content", ""))
+
+
+def prompt_key(method, path, payload):
+    """要求のキー — 本文と n だけで決める（温度・max_tokens・モデル名・stream は含めない）"""
+    n = payload.get("n", 1) if isinstance(payload, dict) else 1
+    h = hashlib.blake2b(f"{method} {path} {n}\0".encode("utf-8"), digest_size=8)
+    h.update(prompt_text(payload).encode("utf-8"))
+    return h.hexdigest()
+
+
+def prompt_blocks(text, size=1024):
+    """size 文字ごとの短いハッシュ列 — どこから食い違ったかを本文なしで示す"""
+    return [hashlib.blake2b(text[i:i + size].encode("utf-8"), digest_size=4).hexdigest()
+            for i in range(0, len(text), size)]
+
+
+class Cassette:
+    """要求/応答の追記専用ファイル（JSONL）
+
+    1行1要求。プロンプトそのものは持たず、キー（prompt_key）と区画ハッシュ（prompt_blocks）だけを書く。
+    生成の応答は候補ごとの差分テキスト列と usage に正規化するので、ストリームで録って非ストリームで
+    再生すること（その逆も）ができる。tokenize は個数だけ。失敗した要求も状態コードつきで残す。
+    entries は load で読んだ分だけ（録音中は書くだけで持たない。長時間の録音でもメモリが増えない）。
+    """
+    BLOCK = 1024
+
+    def __init__(self, path, meta=None):
+        self.path = Path(path)
+        self.header = dict(meta or {})  # 録音時は見出し行に書く（base_url など）
+        self.entries = []
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._f = None
+        self._headed = False
+
+    @classmethod
+    def load(cls, path):
+        """読み込み（書きかけの末尾行は捨てる）"""
+        c = cls(path)
+        with open(c.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue
+                if "p" in e:
+                    c.entries.append(e)
+                elif "v" in e:
+                    c.header = e
+        return c
+
+    def append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._f is None:  # 初回か close の後（再開）
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._f = open(self.path, "a", encoding="utf-8")
+                if not self._headed:
+                    head = dict(self.header, v=1, created=datetime.now().isoformat(timespec="seconds"))
+                    self._f.write(json.dumps(head, ensure_ascii=False) + "\n")
+                    self._headed = True
+            self._f.write(line)
+            self._f.flush()
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            if self._f:
+                self._f.close()
+                self._f = None
+
+
+class _Tee:
+    """ストリーム応答を素通ししながら差分を集め、close で記録する"""
+
+    def __init__(self, r, pick, done):
+        self._r, self._pick, self._done = r, pick, done
+        self.pieces, self.usage, self.first = [], None, None
+
+    def __getattr__(self, name):
+        return getattr(self._r, name)
+
+    def iter_lines(self, *args, **kw):
+        for raw in self._r.iter_lines(*args, **kw):
+            data = raw[5:].strip() if raw.startswith(b"data:") else b""
+            if data and data != b"[DONE]":
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    event = {}
+                if event.get("usage"):
+                    self.usage = event["usage"]
+                choices = event.get("choices") or []
+                delta = self._pick(choices[0]) if choices else None
+                if delta:
+                    if self.first is None:
+                        self.first = time.monotonic()
+                    self.pieces.append(delta)
+            yield raw
+
+    def close(self):
+        self._r.close()
+        done, self._done = self._done, None
+        if done:
+            done(self)
+
+
+class RecordingTransport:
+    """送受信をカセットに書き足す（中身の Transport / TransportPool はそのまま使う）"""
+
+    def __init__(self, inner, cassette):
+        self.inner = inner
+        self.cassette = cassette
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)  # backoff / retry_after / connection_stats / probe ...
+
+    def request(self, method, path, payload=None, stream=False, read_timeout=None, retries=None):
+        e = {"m": method, "p": path, "k": prompt_key(method, path, payload), "st": stream}
+        if isinstance(payload, dict):
+            if payload.get("model"): e["mo"] = payload["model"]
+            if "max_tokens" in payload: e["mt"] = payload["max_tokens"]
+        if path in GEN_PATHS:
+            text = prompt_text(payload)
+            e["ch"], e["b"] = len(text), prompt_blocks(text, Cassette.BLOCK)
+            e["n"] = payload.get("n", 1) if isinstance(payload, dict) else 1  # キーの一部（食い違いの説明用）
+        t0 = time.monotonic()
+        try:
+            r = self.inner.request(method, path, payload, stream=stream, read_timeout=read_timeout, retries=retries)
+        except requests.RequestException as ex:
+            resp = getattr(ex, "response", None)
+            e.update(t=round(time.monotonic() - t0, 4), e=str(ex)[:200],
+                     s=resp.status_code if resp is not None else None)
+            self.cassette.append(e)
+            raise
+        sse = r.headers.get("content-type", "").startswith("text/event-stream")
+        if stream and sse and path in SSE_PICK:
+            def done(tee):
+                now = time.monotonic()
+                e.update(sse=True, t=round(now - t0, 4), f=round((tee.first or now) - t0, 4),
+                         c=[tee.pieces], u=tee.usage or {})
+                self.cassette.append(e)
+            return _Tee(r, SSE_PICK[path], done)
+        try:
+            data = r.json()
+        except ValueError:
+            data = None
+        e["t"] = round(time.monotonic() - t0, 4)
+        e["sse"] = sse
+        if path in GEN_PATHS and isinstance(data, dict) and isinstance(data.get("choices"), list):
+            pick = (lambda ch: (ch.get("message") or {}).get("content")) if "chat" in path else (lambda ch: ch.get("text"))
+            e["c"] = [[pick(ch) or ""] for ch in data["choices"]]
+            e["u"] = data.get("usage") or {}
+        elif path == "/tokenize" and isinstance(data, dict) and "tokens" in data:
+            e["j"] = {"count": len(data["tokens"])}
+        else:
+            e["j"] = data
+        self.cassette.append(e)
+        return r
+
+    def get(self, path, **kw):
+        return self.request("GET", path, **kw)
+
+    def post(self, path, payload, **kw):
+        return self.request("POST", path, payload, **kw)
+
+    def close(self):
+        self.inner.close()
+        self.cassette.close()
+
+
+class _ReplayResponse:
+    """再生用の応答（requests.Response の使われている部分だけ）"""
+
+    def __init__(self, status_code=200, data=None, lines=None, delays=None):
+        self.status_code = status_code
+        self.reason = "replay"
+        self._data = data
+        self._lines = lines
+        self._delays = delays or []
+        self.headers = {"content-type": "text/event-stream" if lines is not None else "application/json"}
+
+    def json(self):
+        if self._data is None:
+            raise ValueError("本文なし（ストリーム応答）")
+        return self._data
+
+    @property
+    def text(self):
+        return json.dumps(self._data, ensure_ascii=False)
+
+    def iter_lines(self, chunk_size=None, **kw):
+        for i, line in enumerate(self._lines or ()):
+            if i < len(self._delays) and self._delays[i] > 0:
+                time.sleep(self._delays[i])
+            yield line
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayTransport:
+    """カセットから応答を返す（ネットワークなし）
+
+    同じキーの要求には録った順に返す。キーが見つからないとき（プロンプト列が変わった、または録った回数より
+    多く同じプロンプトを送った）は、そのパスのまだ返していない応答を録った順に返し（max_tokens が同じものを
+    優先）、食い違いとして記録する。録り尽くしたら先頭から使い回す。
+    latency は録った待ち時間に掛ける倍率（0 で待たない）。
+    tag は食い違いに添える呼び出し側の位置（思考番号など）を返す関数。
+    """
+    MAX_DIVERGENCES = 50
+
+    def __init__(self, cassette, latency=0.0, tag=None):
+        self.cassette = cassette
+        self.latency = latency
+        self.tag = tag
+        self.base_url = cassette.header.get("base_url", f"replay:{cassette.path.name}")
+        self._lock = threading.Lock()
+        self._by_key = {}   # キー → [まだ返していない番号]
+        self._by_path = {}  # パス → deque(番号)
+        self._last = {}     # キー → 最後に返した番号（録った回数を超えた分に使い回す）
+        self._used = set()
+        self._pos = 0       # 最後に返した番号（録音上の現在位置）
+        # 録った最後の生成（これを返したら録音の終わりまで来た）
+        self._gen_last = max((i for i, e in enumerate(cassette.entries) if e["p"] in GEN_PATHS), default=None)
+        self._wrapped = False
+        for i, e in enumerate(cassette.entries):
+            self._by_key.setdefault(e["k"], []).append(i)
+            self._by_path.setdefault(e["p"], deque()).append(i)
+        for q in self._by_key.values():
+            q.reverse()  # pop() で先頭から
+        self.stats = {"requests": 0, "hits": 0, "misses": 0, "beyond": 0, "reused": 0, "unserved": 0}
+        self.by_path = {}
+        self.divergences = []
+
+    # ─── 照合 ───
+
+    def _next_in_path(self, path, mt):
+        """食い違い時の代わり — 録音上の現在位置より後の、そのパスの未使用分（max_tokens が同じものを優先）"""
+        q = self._by_path.get(path)
+        if q is None:
+            return None
+        while q and (q[0] in self._used or q[0] < self._pos):
+            q.popleft()
+        if not q:
+            self.stats["reused"] += 1
+            self._wrapped = True
+            self._pos = 0
+            q.extend(i for i, e in enumerate(self.cassette.entries) if e["p"] == path)
+            self._used.difference_update(q)
+        for j in range(min(16, len(q))):
+            if q[j] not in self._used and self.cassette.entries[q[j]].get("mt") == mt:
+                i = q[j]
+                del q[j]
+                return i
+        return q.popleft()
+
+    def _match(self, method, path, payload):
+        key = prompt_key(method, path, payload)
+        with self._lock:
+            per = self.by_path.setdefault(path, {"hits": 0, "misses": 0})
+            self.stats["requests"] += 1
+            pending = self._by_key.get(key)
+            while pending and pending[-1] in self._used:
+                pending.pop()
+            if pending:
+                i = pending.pop()
+            elif key in self._last and path not in GEN_PATHS:  # 生成は同じ答えを繰り返さない（空の応答で止まる）
+                i = self._last[key]
+                self.stats["reused"] += 1
+            else:
+                i = None
+            if i is not None:
+                self.stats["hits"] += 1
+                per["hits"] += 1
+            else:
+                beyond = self.exhausted()  # 録音の先 — 食い違いではない
+                if beyond:
+                    self.stats["beyond"] += 1
+                else:
+                    self.stats["misses"] += 1
+                    per["misses"] += 1
+                mt = payload.get("max_tokens") if isinstance(payload, dict) else None
+                i = self._next_in_path(path, mt) if path in GEN_PATHS else None
+                if path in GEN_PATHS and not beyond:
+                    self._diverged(path, payload, i)
+                if i is None:
+                    self.stats["unserved"] += 1
+                    return None
+            self._used.add(i)
+            self._last[key] = i
+            self._pos = max(self._pos, i)
+        return self.cassette.entries[i]
+
+    def _diverged(self, path, payload, i):
+        if len(self.divergences) >= self.MAX_DIVERGENCES:
+            return
+        text = prompt_text(payload)
+        d = {"request": self.stats["requests"], "path": path, "chars": len(text), "served": i}
+        if self.tag:
+            d["at"] = self.tag()
+        rec = self.cassette.entries[i] if i is not None else None
+        if rec and "b" in rec:
+            mine = prompt_blocks(text, Cassette.BLOCK)
+            d["recorded_chars"] = rec.get("ch")
+            if mine == rec["b"]:
+                # 本文は同じ — キーの残り（候補数 n）が違う
+                d["n"] = payload.get("n", 1) if isinstance(payload, dict) else 1
+                d["recorded_n"] = rec.get("n")
+            else:
+                k = next((j for j, (a, b) in enumerate(zip(mine, rec["b"])) if a != b), min(len(mine), len(rec["b"])))
+                d["offset"] = k * Cassette.BLOCK
+                d["excerpt"] = text[d["offset"]:d["offset"] + 200]
+        self.divergences.append(d)
+
+    # ─── 応答の組み立て ───
+
+    def _respond(self, e, path, stream):
+        if "e" in e:
+            if e.get("s"):
+                raise requests.HTTPError(f"{e['s']} (replay)", response=_ReplayResponse(e["s"], {}))
+            raise requests.ConnectionError(f"{e['e']} (replay)")
+        scale = self.latency
+        if "c" not in e:
+            if scale and e.get("t"): time.sleep(e["t"] * scale)
+            return _ReplayResponse(data=e.get("j"))
+        chat = path == "/v1/chat/completions"
+        usage = e.get("u") or {}
+        if stream and (e.get("sse") or not e.get("st")):
+            pieces = e["c"][0] if e["c"] else []
+            lines = [b"data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": p}} if chat else
+                                                         {"index": 0, "text": p}]},
+                                            ensure_ascii=False).encode("utf-8") for p in pieces]
+            lines.append(b"data: " + json.dumps({"choices": [], "usage": usage}).encode("utf-8"))
+            lines.append(b"data: [DONE]")
+            delays = []
+            if scale and e.get("t"):
+                first = e.get("f", e["t"])
+                rest = max(0.0, e["t"] - first) / max(1, len(pieces))
+                delays = [first * scale] + [rest * scale] * len(pieces)
+            return _ReplayResponse(lines=lines, delays=delays)
+        if scale and e.get("t"):
+            time.sleep(e["t"] * scale)
+        choices = []
+        for i, pieces in enumerate(e["c"]):
+            text = "".join(pieces)
+            choices.append({"index": i, "finish_reason": "stop",
+                            **({"message": {"role": "assistant", "content": text}} if chat else {"text": text})})
+        return _ReplayResponse(data={"choices": choices, "usage": usage, "model": e.get("mo")})
+
+    # ─── Transport 互換 ───
+
+    def request(self, method, path, payload=None, stream=False, read_timeout=None, retries=None):
+        e = self._match(method, path, payload)
+        if e is None:
+            if path == "/v1/models":  # プール経由で録ると /v1/models は残らない — 録った生成のモデル名で答える
+                model = next((x["mo"] for x in self.cassette.entries if x.get("mo")), "replay")
+                return _ReplayResponse(data={"data": [{"id": model}]})
+            raise requests.ConnectionError(f"カセットにない要求: {method} {path}")
+        return self._respond(e, path, stream)
+
+    def get(self, path, **kw):
+        return self.request("GET", path, **kw)
+
+    def post(self, path, payload, **kw):
+        return self.request("POST", path, payload, **kw)
+
+    def backoff(self, attempt):
+        return 0.0
+
+    def retry_after(self):
+        return 0.0
+
+    def exhausted(self):
+        """録音の最後の生成まで返したか"""
+        return self._wrapped or self._gen_last is None or self._gen_last in self._used
+
+    def connection_stats(self):
+        return dict(self.stats, replay=str(self.cassette.path))
+
+    def report(self):
+        """食い違いの報告（最初の食い違い・パス別の一致数・上限つきの一覧）"""
+        return {"cassette": str(self.cassette.path), "recorded": len(self.cassette.entries), **self.stats,
+                "by_path": self.by_path,
+                "first_divergence": self.divergences[0] if self.divergences else None,
+                "divergences": self.divergences}
+
+    def close(self):
+        pass
+
+
+# ═══════════════════════════════════════════════════════════════════
+# トークン計測
+# ═══════════════════════════════════════════════════════════════════
+
+CJK_RE = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+class TokenCounter:
+    """トークン数の計測 — 較正付きの推定（思考スレッドでは通信しない）
+
+    推定は「かな・漢字は約1文字1トークン、それ以外は約3.5文字1トークン」（raw）を基準に、
+    サーバーが返す usage.prompt_tokens との比で scale を較正する。raw は区画ごとに一度だけ数えて
+    持っておき（ContextBuffer）、トークン数は「raw の合計 × scale」で出す。usage が返らないサーバーでは、
+    sample で /tokenize を裏のスレッドから時々呼んで較正する（続けて失敗したら以後は呼ばない）。
+    """
+    CJK_RATE = 1.0
+    OTHER_RATE = 1 / 3.5
+    MAX_FAILURES = 3
+
+    def __init__(self, transport=None, mode="auto"):
+        self.transport = transport
+        self.mode = mode      # auto: tokenize で較正する / local: usage での較正のみ
+        self.remote = None    # tokenize エンドポイントの有無（None は未確認）
+        self.scale = 1.0
+        self.calibrated = False
+        self.failures = 0     # tokenize の連続失敗
+        self._sampling = False
+
+    def raw(self, text):
+        """較正前の推定（scale に依らない）"""
+        cjk = len(CJK_RE.findall(text))
+        return cjk * self.CJK_RATE + (len(text) - cjk) * self.OTHER_RATE
+
+    def estimate(self, text):
+        return self.tokens(self.raw(text)) if text else 0
+
+    def tokens(self, raw):
+        return max(1, round(raw * self.scale)) if raw else 0
+
+    def sample(self, text):
+        """text を /tokenize で数えて較正する（裏のスレッドで。実行中・未対応・local なら何もしない）"""
+        if self.mode != "auto" or not self.transport or self.remote is False or self._sampling or not text:
+            return
+        self._sampling = True
+        threading.Thread(target=self._sample, args=(text,), daemon=True).start()
+
+    def _sample(self, text):
+        try:
+            r = self.transport.post("/tokenize", {"content": text}, read_timeout=5, retries=0)
+            data = r.json()
+            n = len(data["tokens"]) if "tokens" in data else int(data["count"])
+            self.remote, self.failures = True, 0
+            self.calibrate(self.raw(text), n)
+        except requests.HTTPError:
+            self.remote = False  # 未対応（404 など）
+        except Exception:
+            self.failures += 1
+            if self.failures >= self.MAX_FAILURES:
+                self.remote = False
+        finally:
+            self._sampling = False
+
+    def calibrate(self, raw, actual_tokens, alpha=0.2):
+        """実測トークン数で推定の倍率を更新（EWMA）— raw は同じテキストの較正前の推定"""
+        if not raw or not actual_tokens:
+            return
+        ratio = actual_tokens / raw
+        self.scale = ratio if not self.calibrated else (1 - alpha) * self.scale + alpha * ratio
+        self.calibrated = True
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 文脈バッファ
+# ═══════════════════════════════════════════════════════════════════
+
+class Segment:
+    """文脈の 1 区画 — 文字数・較正前のトークン推定（raw）・内容ハッシュを保持"""
+    __slots__ = ("kind", "text", "chars", "raw", "hash")
+
+    def __init__(self, kind, text, raw=None):
+        self.kind = kind
+        self.text = text
+        self.chars = len(text)
+        self.raw = raw
+        self.hash = hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+    def __repr__(self):
+        return f"<Segment {self.kind} {self.chars}ch {self.hash}>"
+
+
+class ContextBuffer:
+    """種類付き区画の列 — 追記 O(1)、先頭からの安価な切り詰め、描画は変更時のみ
+
+    種類: seed / tools / thought / human / response / memory / tool_result
+    退避方針: pin（退避しない）/ evict（区画ごと捨てる）/ trim（区画の先頭を削る）
+    """
+    DEFAULT_POLICIES = {"seed": "pin", "tools": "pin", "memory": "pin",
+                        "thought": "evict", "human": "evict", "response": "evict", "tool_result": "evict"}
+
+    def __init__(self, text="", kind="seed", policies=None, token_counter=None):
+        self.policies = dict(self.DEFAULT_POLICIES, **(policies or {}))
+        self.token_counter = token_counter
+        self.segments = deque()
+        self.chars = 0
+        self.raw = 0.0  # 区画の raw の合計（token_counter がある時のみ意味を持つ）
+        self.version = 0
+        self.epoch = 0    # 追記以外の変更（置換・組み直し・切り詰め）で増える
+        self.appends = 0  # 追記の累計（epoch が同じなら末尾 appends 差分が新しい区画）
+        self._rendered = ("", -1)
+        if text:
+            self.append(kind, text)
+
+    def __len__(self):
+        return self.chars
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    @property
+    def tokens(self):
+        """トークン数 — raw の合計に今の scale を掛ける（較正が変わっても区画を数え直さない）"""
+        return self.token_counter.tokens(self.raw) if self.token_counter else 0
+
+    def seg_tokens(self, seg):
+        return self.token_counter.tokens(seg.raw or 0) if self.token_counter else 0
+
+    def _make(self, kind, text):
+        raw = self.token_counter.raw(text) if self.token_counter else None
+        return Segment(kind, text, raw)
+
+    def append(self, kind, text):
+        seg = self._make(kind, text)
+        self.segments.append(seg)
+        self.chars += seg.chars
+        self.raw += seg.raw or 0
+        self.version += 1
+        self.appends += 1
+        return seg
+
+    def since(self, appends):
+        """追記累計が appends だった時点より後に追記された区画"""
+        n = self.appends - appends
+        return list(reversed([seg for _, seg in zip(range(n), reversed(self.segments))])) if n > 0 else []
+
+    def reset(self, parts):
+        """全区画を置き換える — parts は [(kind, text), ...] または単一の文字列（seed）"""
+        if isinstance(parts, str):
+            parts = [("seed", parts)]
+        self.segments = deque(self._make(k, t) for k, t in parts if t)
+        self.chars = sum(seg.chars for seg in self.segments)
+        self.raw = sum(seg.raw or 0 for seg in self.segments)
+        self.version += 1
+        self.epoch += 1
+
+    def rebuild(self, items):
+        """区画を組み直す — items は既存の Segment（計測済みのまま再利用）か新しく作る (kind, text)"""
+        self.segments = deque(item if isinstance(item, Segment) else self._make(*item)
+                              for item in items if isinstance(item, Segment) or item[1])
+        self.chars = sum(seg.chars for seg in self.segments)
+        self.raw = sum(seg.raw or 0 for seg in self.segments)
+        self.version += 1
+        self.epoch += 1
+
+    def render(self):
+        """プロンプト用の文字列 — 変更がなければ前回の結果を返す"""
+        text, version = self._rendered
+        if version != self.version:
+            text = "".join(seg.text for seg in self.segments)
+            self._rendered = (text, self.version)
+        return text
+
+    def tail(self, n):
+        """末尾 n 文字（全体を描画しない）"""
+        parts, need = [], n
+        for seg in reversed(self.segments):
+            if need <= 0:
+                break
+            parts.append(seg.text[-need:])
+            need -= seg.chars
+        return "".join(reversed(parts))
+
+    def size(self, unit="chars"):
+        return self.tokens if unit == "tokens" else self.chars
+
+    def kinds(self, *kinds):
+        return [seg for seg in self.segments if seg.kind in kinds]
+
+    def truncate_front(self, limit, unit="chars"):
+        """方針に従い古い区画から退避して limit 以下にする（unit: chars / tokens）。退避した量を返す"""
+        removed = 0
+        pinned = []
+        while self.size(unit) > limit and self.segments:
+            seg = self.segments.popleft()
+            policy = self.policies.get(seg.kind, "evict")
+            if policy == "pin":
+                pinned.append(seg)
+                continue
+            over = self.size(unit) - limit
+            seg_size = self.seg_tokens(seg) if unit == "tokens" else seg.chars
+            if policy == "trim" and seg_size > over:
+                cut = max(1, int(seg.chars * over / seg_size)) if unit == "tokens" else over
+                kept = self._make(seg.kind, seg.text[cut:])
+                self.segments.appendleft(kept)
+                self.chars -= seg.chars - kept.chars
+                self.raw -= (seg.raw or 0) - (kept.raw or 0)
+                removed += seg_size - (self.seg_tokens(kept) if unit == "tokens" else kept.chars)
+                break
+            self.chars -= seg.chars
+            self.raw -= seg.raw or 0
+            removed += seg_size
+        self.segments.extendleft(reversed(pinned))
+        if removed:
+            self.version += 1
+            self.epoch += 1
+        return removed
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 反復検出
+# ═══════════════════════════════════════════════════════════════════
+
+def ngram_hashes(text, n=4):
+    """文字 n-gram のハッシュ集合（日本語は分かち書きがないので文字単位）"""
+    return {hash(text[i:i + n]) for i in range(max(1, len(text) - n + 1))} if text else set()
+
+
+class NoveltyDetector:
+    """思考ごとに O(新しいテキスト) で更新する新規性・エントロピーの計測
+
+    novelty: 新しい思考の n-gram のうち、直近 window 思考に現れなかった割合
+    entropy: 直近 window の n-gram 分布のエントロピーを log2(総数) で割った値（全て異なれば 1、反復で下がる）
+    score:   novelty の EWMA。threshold を下回ると崩壊とみなす
+    """
+
+    def __init__(self, n=4, window=30, threshold=0.25, alpha=0.3, warmup=5):
+        self.n = n
+        self.threshold = threshold
+        self.alpha = alpha
+        self.warmup = warmup
+        self._window = deque(maxlen=window)
+        self._counts = Counter()
+        self._total = 0
+        self._clogc = 0.0  # Σ c·log2(c)（エントロピーの差分更新用）
+        self.count = 0
+        self.novelty = 1.0
+        self.entropy = 1.0
+        self.score = 1.0
+
+    def _bump(self, gram, delta):
+        c = self._counts[gram]
+        c2 = c + delta
+        self._clogc += (c2 * math.log2(c2) if c2 > 0 else 0.0) - (c * math.log2(c) if c > 0 else 0.0)
+        self._total += delta
+        if c2:
+            self._counts[gram] = c2
+        else:
+            del self._counts[gram]
+
+    def update(self, text):
+        grams = ngram_hashes(text, self.n)
+        if grams:
+            fresh = sum(1 for g in grams if g not in self._counts)
+            self.novelty = fresh / len(grams)
+        if len(self._window) == self._window.maxlen:
+            for g in self._window[0]:
+                self._bump(g, -1)
+        self._window.append(grams)
+        for g in grams:
+            self._bump(g, 1)
+        self.count += 1
+        if self._total > 1:
+            h = math.log2(self._total) - self._clogc / self._total
+            self.entropy = h / math.log2(self._total)
+        self.score = self.novelty if self.count == 1 else (1 - self.alpha) * self.score + self.alpha * self.novelty
+        return self.score
+
+    def peek(self, text, extra=frozenset()):
+        """状態を変えずに novelty だけ計算（候補の比較用）。extra は窓に加えて比べる n-gram"""
+        grams = ngram_hashes(text, self.n)
+        if not grams:
+            return 0.0
+        return sum(1 for g in grams if g not in self._counts and g not in extra) / len(grams)
+
+    def collapsed(self):
+        return self.count >= self.warmup and self.score < self.threshold
+
+    def stats(self):
+        return {"novelty": round(self.novelty, 3), "entropy": round(self.entropy, 3), "score": round(self.score, 3)}
+
+    def reset(self):
+        self.__init__(self.n, self._window.maxlen, self.threshold, self.alpha, self.warmup)
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 記憶（階層要約）
+# ═══════════════════════════════════════════════════════════════════
+
+class RollingSummarizer:
+    """ログ構造の階層要約 — 古い区画を固定長のチャンクごとに要約し、同じ階層に
+    fanout 個たまったら 1 つ上の階層へ統合する
+
+    1 回の圧縮ステップは「チャンク要約」か「統合」のどちらか 1 回の生成だけ。
+    過去の記憶の核は捨てずに木として持ち続ける。
+    """
+    FIXED_KINDS = ("tools", "memory")
+
+    def __init__(self, chunk_chars=4000, fanout=4):
+        self.chunk_chars = chunk_chars
+        self.fanout = fanout
+        self.levels = [[]]  # levels[0] がチャンク要約、上ほど抽象的
+
+    def plan(self, segments):
+        """次の 1 ステップを決める。{"kind": "merge"|"chunk", ...} または None"""
+        for level, items in enumerate(self.levels):
+            if len(items) >= self.fanout:
+                text = "\n".join(f"- {s}" for s in items[:self.fanout])
+                return {"kind": "merge", "level": level, "prompt": (
+                    "以下は過去の思考の要約の列である。重複を除き、最も重要な洞察と"
+                    "未解決の問いを一つの短い要約に統合してください。\n\n"
+                    f"要約:\n{text}\n\n"
+                    "統合:"
+                )}
+        agable = [seg for seg in segments if seg.kind not in self.FIXED_KINDS][:-1]  # 最新の区画は残す
+        chunk, size = [], 0
+        for seg in agable:
+            if chunk and size + seg.chars > self.chunk_chars * 2:
+                break  # 次の区画は次のステップで畳む
+            chunk.append(seg)
+            size += seg.chars
+            if size >= self.chunk_chars:
+                break
+        if not chunk:
+            return None
+        text = "".join(seg.text for seg in chunk)
+        rest = None
+        if size > self.chunk_chars * 2:
+            # 1 区画だけで長すぎる — 先頭を畳み、残り（rest）は区画として文脈に残す
+            text, rest = text[:self.chunk_chars], text[self.chunk_chars:]
+            size = len(text)
+        return {"kind": "chunk", "level": 0, "segments": chunk, "chars": size, "rest": rest, "prompt": (
+            "以下の思考の流れから、最も重要な洞察と未解決の問いだけを抽出してください。"
+            "結論やまとめは不要。核心の洞察と、次に探求すべき問いだけ残してください。\n\n"
+            f"思考:\n{text}\n\n"
+            "核心:"
+        )}
+
+    def commit(self, step, summary):
+        level = step["level"]
+        if step["kind"] == "merge":
+            del self.levels[level][:self.fanout]
+            level += 1
+            if level == len(self.levels):
+                self.levels.append([])
+        self.levels[level].append(summary)
+
+    def render(self):
+        """文脈に置く記憶の核 — 古く抽象的なものから順に"""
+        items = [s for level in reversed(self.levels) for s in level]
+        if not items:
+            return ""
+        return "[記憶の核]:\n" + "\n".join(f"- {s}" for s in items) + "\n\n"
+
+    def reset(self):
+        self.levels = [[]]
+
+
+# ═══════════════════════════════════════════════════════════════════
+# プロンプト
+# ═══════════════════════════════════════════════════════════════════
+
+TOOLS_PAUSED_SUFFIX = "\n（ツールは少しの間使えない。言葉で考え続ける）\n"
+
+
+class PromptBuilder:
+    """プレフィックス安定なプロンプト組み立て — 文脈は追記のみ、一時的な指示は末尾に付ける
+
+    サーバーのプロンプト/KVキャッシュを再利用させるため、文脈の途中を削除・置換しない。
+    直前に送ったプロンプトとの共通プレフィックス長から再利用率を測る。
+    """
+
+    def __init__(self, cache_prompt=True, id_slot=None):
+        self.cache_prompt = cache_prompt  # llama.cpp 互換: プロンプトキャッシュを使う
+        self.id_slot = id_slot            # llama.cpp 互換: 固定スロット（None なら指定しない）
+        self._last = ""
+        self.last_reuse = 0.0
+
+    def build(self, context, suffix=""):
+        prompt = context + suffix if suffix else context
+        shared = self.common_prefix(self._last, prompt)
+        self.last_reuse = shared / len(prompt) if prompt else 0.0
+        self._last = prompt
+        return prompt
+
+    def hints(self):
+        """キャッシュ用の追加ペイロード"""
+        h = {}
+        if self.cache_prompt:
+            h["cache_prompt"] = True
+        if self.id_slot is not None:
+            h["id_slot"] = self.id_slot
+        return h
+
+    @staticmethod
+    def common_prefix(a, b):
+        """共通プレフィックス長（startswith の二分探索で C レベル比較に任せる）"""
+        n = min(len(a), len(b))
+        if a[:n] == b[:n]:
+            return n
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if b.startswith(a[:mid]):
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+
+# ═══════════════════════════════════════════════════════════════════
+# ログ書き込み
+# ═══════════════════════════════════════════════════════════════════
+
+class LogWriter:
+    """JSONL の非同期書き込み — 有界キュー、まとめ書き、flush/fsync 方針、ローテーション
+
+    思考スレッドは dict をキューに積むだけ。直列化・書き込み・ローテーションは専用スレッドで行い、
+    閉じたセグメント（<stem>.0001.jsonl ...）は別スレッドで gzip（zstandard があれば zstd）に圧縮する。
+    ファイルは最初の書き込みまで作らない。
+    """
+    _instances = weakref.WeakSet()
+
+    def __init__(self, path, queue_size=10000, batch=512, flush_interval=1.0, fsync_interval=None,
+                 rotate_mb=None, rotate_hours=None, archive="gzip", tracer=None):
+        self.path = Path(path)
+        self.batch = batch
+        self.flush_interval = flush_interval    # この間隔で OS へ flush
+        self.fsync_interval = fsync_interval    # None なら flush(fsync=True)/close 時のみ
+        self.rotate_bytes = rotate_mb * 1024 * 1024 if rotate_mb else None
+        self.rotate_seconds = rotate_hours * 3600 if rotate_hours else None
+        self.archive = archive                  # gzip / zstd / None
+        self.segments = 0
+        self.skipped = 0                        # 直列化できずに捨てたイベント数
+        self.tracer = tracer if tracer is not None else Tracer()  # 書き込み区間の記録先
+        self._q = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        LogWriter._instances.add(self)
+
+    def write(self, event):
+        """イベントを積む（キューが満杯なら空くまで待つ）"""
+        self._ensure_thread()
+        self._q.put(("event", event, None))
+
+    def flush(self, fsync=False, timeout=10):
+        return self._control("flush", fsync, timeout)
+
+    def rename(self, new_path, timeout=10):
+        """書き込み順を保ったまま現在のファイルを改名"""
+        return self._control("rename", Path(new_path), timeout)
+
+    def close(self, timeout=10):
+        if self._thread and self._thread.is_alive():
+            self._control("close", None, timeout)
+            self._thread.join(timeout)
+
+    def _control(self, op, arg, timeout):
+        if op == "rename" and not (self._thread and self._thread.is_alive()):
+            if self.path.exists():
+                self.path.rename(arg)
+            self.path = arg
+            return True
+        self._ensure_thread()
+        done = threading.Event()
+        self._q.put((op, arg, done))
+        return done.wait(timeout)
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        f, opened_at = None, 0.0
+        last_flush = last_fsync = time.monotonic()
+        while True:
+            try:
+                items = [self._q.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < self.batch:
+                try:
+                    items.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for op, arg, done in items:
+                if op == "event":
+                    try:
+                        lines.append(json.dumps(arg, ensure_ascii=False) + "\n")
+                    except (TypeError, ValueError) as e:  # 1 件のために書き込みスレッドを止めない
+                        self.skipped += 1
+                        print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠ ログ直列化失敗（{self.path.name}、捨てた）: {e}")
+                    continue
+                f, opened_at = self._write(f, opened_at, lines); lines = []
+                if op == "flush":
+                    if f:
+                        f.flush()
+                        if arg: os.fsync(f.fileno())
+                elif op == "rename":
+                    if f: f.close(); f = None
+                    if self.path.exists():
+                        self.path.rename(arg)
+                    self.path = arg
+                elif op == "close":
+                    if f:
+                        f.flush(); os.fsync(f.fileno()); f.close()
+                    done.set()
+                    return
+                done.set()
+            f, opened_at = self._write(f, opened_at, lines)
+
+            now = time.monotonic()
+            if f and (not items or now - last_flush >= self.flush_interval):
+                f.flush(); last_flush = now
+                if self.fsync_interval is not None and now - last_fsync >= self.fsync_interval:
+                    os.fsync(f.fileno()); last_fsync = now
+
+    def _write(self, f, opened_at, lines):
+        if not lines:
+            return f, opened_at
+        with self.tracer.span("log.write", lines=len(lines)):
+            return self._write_lines(f, opened_at, lines)
+
+    def _write_lines(self, f, opened_at, lines):
+        if f is None:
+            f = open(self.path, "a", encoding="utf-8")
+            opened_at = time.monotonic()
+        f.write("".join(lines))
+        if ((self.rotate_bytes and f.tell() >= self.rotate_bytes) or
+                (self.rotate_seconds and time.monotonic() - opened_at >= self.rotate_seconds)):
+            f.flush(); os.fsync(f.fileno()); f.close()
+            self._rotate()
+            return None, 0.0
+        return f, opened_at
+
+    def _rotate(self):
+        """現在のファイルを番号付きセグメントにして、裏で圧縮"""
+        self.segments += 1
+        closed = self.path.with_name(f"{self.path.stem}.{self.segments:04d}{self.path.suffix}")
+        while closed.exists():
+            self.segments += 1
+            closed = self.path.with_name(f"{self.path.stem}.{self.segments:04d}{self.path.suffix}")
+        self.path.rename(closed)
+        if self.archive:
+            threading.Thread(target=self._compress_segment, args=(closed, self.archive), daemon=True).start()
+
+    @staticmethod
+    def _compress_segment(path, archive):
+        try:
+            if archive == "zstd":
+                try:
+                    import zstandard
+                except ImportError:
+                    archive = "gzip"
+            dst = path.with_name(path.name + (".zst" if archive == "zstd" else ".gz"))
+            tmp = dst.with_name(dst.name + ".tmp")
+            with open(path, "rb") as src:
+                if archive == "zstd":
+                    with open(tmp, "wb") as out:
+                        zstandard.ZstdCompressor().copy_stream(src, out)
+                else:
+                    with gzip.open(tmp, "wb") as out:
+                        shutil.copyfileobj(src, out, 1024 * 1024)
+            tmp.rename(dst)
+            path.unlink()
+        except Exception as e:
+            print(f"[ログ圧縮エラー] {path.name}: {e}")
+
+    @classmethod
+    def close_all(cls):
+        for w in list(cls._instances):
+            w.close(timeout=5)
+
+
+atexit.register(LogWriter.close_all)
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 計測（Prometheus 形式）
+# ═══════════════════════════════════════════════════════════════════
+
+class Histogram:
+    """固定バケットの累積ヒストグラム — 記憶量は観測数によらず一定"""
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.count += 1
+        self.sum += v
+        for i, b in enumerate(self.buckets):
+            if v <= b:
+                self.counts[i] += 1
+                break
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class Metrics:
+    """カウンタ・ヒストグラム・ゲージの登録簿。render() で /metrics のテキストを返す"""
+    LATENCY = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+    SIZE = (1000, 2000, 4000, 8000, 16000, 32000, 48000, 64000, 96000, 128000, 200000)
+    RATE = (1, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+    RATIO = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+    def __init__(self, prefix="isbe"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}    # name → {labels: value}
+        self._histograms = {}  # name → {labels: Histogram}
+        self._buckets = {}
+        self._gauges = {}      # name → 呼び出し時に値を返す関数
+
+    def counter(self, name, help="", labeled=False):
+        self._help[name] = ("counter", help)
+        self._counters.setdefault(name, {} if labeled else {(): 0})
+
+    def histogram(self, name, buckets, help=""):
+        self._help[name] = ("histogram", help)
+        self._histograms.setdefault(name, {})
+        self._buckets[name] = buckets
+
+    def gauge(self, name, fn, help=""):
+        self._help[name] = ("gauge", help)
+        self._gauges[name] = fn
+
+    def inc(self, name, v=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + v
+
+    def observe(self, name, v, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name]
+            h = series.get(key)
+            if h is None:
+                h = series[key] = Histogram(self._buckets[name])
+            h.observe(v)
+
+    def get(self, name, **labels):
+        """ヒストグラム（なければ None）"""
+        return self._histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+    @staticmethod
+    def _escape(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @classmethod
+    def _labels(cls, key, extra=()):
+        items = list(key) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{cls._escape(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        out = []
+        with self._lock:
+            for name, (kind, help) in self._help.items():
+                full = f"{self.prefix}_{name}"
+                out.append(f"# HELP {full} {help}")
+                out.append(f"# TYPE {full} {kind}")
+                if kind == "counter":
+                    for key, v in self._counters[name].items():
+                        out.append(f"{full}{self._labels(key)} {v}")
+                elif kind == "histogram":
+                    for key, h in self._histograms[name].items():
+                        acc = 0
+                        for b, c in zip(h.buckets, h.counts):
+                            acc += c
+                            out.append(f"{full}_bucket{self._labels(key, [('le', b)])} {acc}")
+                        out.append(f"{full}_bucket{self._labels(key, [('le', '+Inf')])} {h.count}")
+                        out.append(f"{full}_sum{self._labels(key)} {h.sum}")
+                        out.append(f"{full}_count{self._labels(key)} {h.count}")
+                else:
+                    try:
+                        out.append(f"{full} {float(self._gauges[name]())}")
+                    except Exception:
+                        out.pop(); out.pop()
+        return "\n".join(out) + "\n"
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """GET /metrics を返す HTTP サーバーを別スレッドで起動（Gradio 不要）"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ═══════════════════════════════════════════════════════════════════
+# トレース（Chrome trace-event / cProfile）
+# ═══════════════════════════════════════════════════════════════════
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "t0")
+
+    def __init__(self, tracer, name, args):
+        self.tracer, self.name, self.args = tracer, name, args
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.t0, time.perf_counter_ns(), self.args)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """区間（span）の記録 — Chrome trace-event JSON に書き出して Perfetto / chrome://tracing で見る
+
+    無効時の span() は使い回しの空オブジェクトを返すだけ（時刻も取らず、何も積まない）。
+    記録は capacity 件のリングバッファ。名前の "." より前が分類（http / think / tool ...）になる。
+    cProfile は思考スレッドで seconds 秒だけ回して .prof に書き出す（profile_tick をループから呼ぶ）。
+    """
+
+    def __init__(self, enabled=False, capacity=200000):
+        self.enabled = enabled
+        self._events = deque(maxlen=capacity)  # (name, t0_ns, dur_ns, tid, args)
+        self._threads = {}                     # native id → スレッド名
+        self._profile_req = None               # (seconds, path)
+        self._profiler = None                  # (cProfile.Profile, 終了時刻, path)
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, args)
+
+    def complete(self, name, t0, t1, args=None):
+        """perf_counter_ns の t0〜t1 を1区間として積む（with で囲めない区間用）"""
+        if not self.enabled:
+            return
+        tid = threading.get_native_id()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        self._events.append((name, t0, t1 - t0, tid, args))
+
+    def __len__(self):
+        return len(self._events)
+
+    def clear(self):
+        self._events.clear()
+
+    def export(self, path):
+        """これまでの区間を書き出す（書き終えてから置き換えるので、読み手は途中を見ない）"""
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "IS-BE"}}]
+        events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                   for tid, name in list(self._threads.items())]
+        for name, t0, dur, tid, args in list(self._events):
+            e = {"name": name, "cat": name.split(".")[0], "ph": "X", "ts": t0 / 1000, "dur": dur / 1000,
+                 "pid": pid, "tid": tid}
+            if args:
+                e["args"] = args
+            events.append(e)
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return path
+
+    def request_profile(self, seconds, path):
+        """次の profile_tick から seconds 秒、呼んだスレッドを cProfile で測る（どのスレッドからでも可）"""
+        self._profile_req = (seconds, Path(path))
+
+    def profile_tick(self, final=False):
+        """思考ループの各周で呼ぶ。要求があれば開始し、時間が来たら（final なら即）書き出して path を返す"""
+        if self._profile_req is None and self._profiler is None:
+            return None
+        if self._profiler is None:
+            if final:
+                return None
+            import cProfile
+            (seconds, path), self._profile_req = self._profile_req, None
+            prof = cProfile.Profile()
+            self._profiler = (prof, time.monotonic() + seconds, path)
+            prof.enable()
+            return None
+        prof, until, path = self._profiler
+        if not final and time.monotonic() < until:
+            return None
+        prof.disable()
+        self._profiler = None
+        prof.dump_stats(str(path))
+        return path
+
+
+# ═══════════════════════════════════════════════════════════════════
+# チェックポイント（クラッシュ後の再開）
+# ═══════════════════════════════════════════════════════════════════
+
+class CheckpointJournal:
+    """追記型のチェックポイント — 1行目が全体（base）、以降は差分（delta）
+
+    差分は前回から追記された文脈区画と状態値だけなので、文脈が大きくても1回の書き込みは小さい。
+    全体は一時ファイルに書いて rename で置き換える（途中で落ちても前の版が残る）。
+    ジャーナルが base の compact_ratio 倍を超えたら全体を書き直して縮める。
+    末尾の書きかけの行は読み込み時に捨てる。
+    submit で積んだ分は専用スレッドが直列化して書く（思考スレッドはファイルを待たない）。
+    """
+
+    def __init__(self, path, compact_ratio=2.0, fsync=False, queue_size=64, tracer=None):
+        self.path = Path(path)
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        self.base_bytes = 0
+        self.bytes = 0
+        self.errors = 0
+        self.tracer = tracer if tracer is not None else Tracer()
+        self._q = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, delta, base):
+        """書き込みを積む — delta を追記し、追記できなければ（初回・縮める時・書き込み失敗の後）base を書く
+
+        どちらも思考スレッドで写し取った状態（以後書き換えない値）を渡す。キューが満杯なら空くまで待つ。
+        """
+        self._ensure_thread()
+        self._q.put((delta, base, None))
+
+    def flush(self, timeout=10):
+        """積んだ分を書き切るまで待つ"""
+        if not (self._thread and self._thread.is_alive()):
+            return True
+        done = threading.Event()
+        self._q.put((None, None, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._thread and self._thread.is_alive():
+            self._q.put(None)
+            self._thread.join(timeout)
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                return
+            delta, base, done = item
+            if done:
+                done.set()
+                continue
+            try:
+                with self.tracer.span("checkpoint.write"):
+                    if not (delta is not None and self.delta(delta)):
+                        self.base(base)
+            except Exception as e:
+                self.errors += 1
+                self.base_bytes = 0  # 差分の連なりが切れたので、次は全体を書き直す
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠ チェックポイント失敗: {e}")
+
+    def base(self, record):
+        data = (json.dumps(dict(record, t="base"), ensure_ascii=False) + "\n").encode("utf-8")
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.base_bytes = self.bytes = len(data)
+
+    def delta(self, record):
+        """差分を追記。縮めるべき時は False（呼び出し側が base を書く）"""
+        if not self.base_bytes or self.bytes > max(self.base_bytes * self.compact_ratio, 64 * 1024):
+            return False
+        data = (json.dumps(dict(record, t="delta"), ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            if self.fsync: os.fsync(f.fileno())
+        self.bytes += len(data)
+        return True
+
+    @classmethod
+    def load(cls, path):
+        """base に delta を順に重ねた状態を返す"""
+        state = None
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break  # 書きかけ
+                if rec.get("t") == "base":
+                    state = rec
+                elif state is not None:
+                    state["segments"].extend(rec.pop("append", []))
+                    state["thought_log"].extend(rec.pop("thoughts", []))
+                    state.update(rec)
+        if state is None:
+            raise ValueError(f"チェックポイントが空です: {path}")
+        return state
+
+    @staticmethod
+    def latest(log_dir):
+        files = sorted(Path(log_dir).glob("ckpt_*.jsonl"))
+        return files[-1] if files else None
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 記憶索引（remember ツール）
+# ═══════════════════════════════════════════════════════════════════
+
+def fts_query(text, max_terms=32):
+    """trigram の OR 検索式（語の区切りがない日本語向け）"""
+    chars = re.sub(r'[\s\W_]+', '', text)
+    grams = []
+    for i in range(len(chars) - 2):
+        g = chars[i:i + 3]
+        if g not in grams:
+            grams.append(g)
+        if len(grams) >= max_terms:
+            break
+    return " OR ".join(f'"{g}"' for g in grams)
+
+
+def fts_fetch(conn, sql, params, timeout):
+    """timeout 秒で打ち切る検索。時間切れ・エラーは空"""
+    deadline = time.monotonic() + timeout
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+    try:
+        return conn.execute(sql, params).fetchall()
+    except sqlite3.Error:
+        return []
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+class MemoryStore:
+    """過去の思考・記憶の核・対話の永続索引（SQLite FTS5 trigram）
+
+    _log のたびにキューへ積み、専用スレッドがまとめて挿入する。起動時には is_be_log の
+    過去セッションを一度だけ取り込み（ファイルごとの読込位置を記録）、検索時にファイルは読まない。
+    検索は時間予算を超えたら打ち切る。
+    索引は補助なので、キューが満杯・索引が開けない・閉じた後の行は捨てる（ログには残っており、次回の取り込みで拾う）。
+    """
+    KINDS = ("thought", "compress", "dialog")
+    SESSION_RE = re.compile(r'^full_(\d{8}_\d{6})')
+
+    def __init__(self, log_dir, db_name="memory.db", queue_size=10000):
+        self.log_dir = Path(log_dir)
+        self.db_path = self.log_dir / db_name
+        self._q = queue.Queue(maxsize=queue_size)
+        self._reader = None
+        self.ready = threading.Event()
+        self.failed = False   # 索引を開けなかった（以後の add は捨てる）
+        self.closed = False
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # ─── 書き込み（専用スレッド）───
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS events(
+                    id INTEGER PRIMARY KEY, session TEXT, n INTEGER, kind TEXT, content TEXT, chash TEXT,
+                    UNIQUE(session, kind, n, chash));
+                CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+                    content, content='events', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS events_ai AFTER INSERT ON events BEGIN
+                    INSERT INTO events_fts(rowid, content) VALUES (new.id, new.content);
+                END;
+                CREATE TABLE IF NOT EXISTS ingested(file TEXT PRIMARY KEY, size INTEGER, offset INTEGER);
+            """)
+        except sqlite3.Error as e:
+            print(f"[記憶索引エラー] {e}")
+            self.failed = True
+            return
+        self.ready.set()
+        self._backfill(conn)
+        while True:
+            rows = [self._q.get()]
+            while len(rows) < 500 and rows[-1] is not None:
+                try:
+                    rows.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            if rows[-1] is None:  # close
+                self._insert(conn, rows[:-1])
+                conn.close()
+                return
+            self._insert(conn, rows)
+
+    def _insert(self, conn, rows):
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO events(session, n, kind, content, chash) VALUES (?,?,?,?,?)",
+                                 rows)
+        except sqlite3.Error as e:
+            print(f"[記憶索引エラー] {e}")
+
+    @classmethod
+    def _row(cls, session, e):
+        kind = e.get("k")
+        if kind not in cls.KINDS or not e.get("c"):
+            return None
+        content = f"{e['human']}\n{e['c']}" if kind == "dialog" and e.get("human") else e["c"]
+        chash = hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+        return (session, e.get("n", 0), kind, content, chash)
+
+    def _backfill(self, conn):
+        """過去のログを取り込む（追記分だけ）。ローテーション後の重複は UNIQUE で弾く"""
+        done = dict((f, (size, off)) for f, size, off in conn.execute("SELECT file, size, offset FROM ingested"))
+        for path in sorted(self.log_dir.glob("full_*.jsonl*")):
+            if path.name.endswith(".idx") or path.name.endswith(".tmp"):
+                continue
+            m = self.SESSION_RE.match(path.name)
+            if not m:
+                continue
+            size = path.stat().st_size
+            prev_size, offset = done.get(path.name, (0, 0))
+            if prev_size == size:
+                continue
+            if path.suffix != ".jsonl":
+                offset = 0
+            rows = []
+            try:
+                with _open_log(path) as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        offset += len(line)
+                        try:
+                            row = self._row(m.group(1), json.loads(line))
+                        except ValueError:
+                            continue
+                        if row: rows.append(row)
+            except Exception as e:
+                print(f"[記憶索引] {path.name}: {e}")
+                continue
+            self._insert(conn, rows)
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO ingested VALUES (?,?,?)", (path.name, size, offset))
+
+    def add(self, session, event):
+        if self.failed or self.closed:
+            return
+        row = self._row(session, event)
+        if row:
+            try:
+                self._q.put_nowait(row)
+            except queue.Full:
+                self.dropped += 1
+
+    def close(self, timeout=10):
+        """積んだ分を書いてスレッドを止める"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._thread.is_alive():
+            self._q.put(None)
+            self._thread.join(timeout)
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    # ─── 検索 ───
+
+    def search(self, text, k=5, timeout=0.2, exclude_session=None, exclude_after=None):
+        """上位 k 件 [(kind, n, session, content)] — timeout 秒を超えたら打ち切り"""
+        q = fts_query(text)
+        if not q or not self.ready.is_set() or self.closed:
+            return []
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.db_path, check_same_thread=False, timeout=1)
+        return fts_fetch(self._reader,
+                         "SELECT e.kind, e.n, e.session, e.content FROM events_fts f JOIN events e ON e.id = f.rowid "
+                         "WHERE events_fts MATCH ? AND NOT (e.session = ? AND e.n > ?) "
+                         "ORDER BY bm25(events_fts) LIMIT ?",
+                         (q, exclude_session or "", exclude_after if exclude_after is not None else -1, k), timeout)
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 検索コーパス（search ツール・オフライン）
+# ═══════════════════════════════════════════════════════════════════
+
+class SearchCorpus:
+    """ローカル文書ディレクトリの BM25 検索（SQLite FTS5 の転置索引、mmap で開く）
+
+    対応形式: .txt / .md（段落ごとに分割）、.jsonl（1行1文書: text/content と title）。
+    索引は変更のあったファイルだけ作り直す。ネットワークは使わない。
+    索引はコーパスのパスごとに index_dir に 1 つ置き、ログの場所が違う心（eval の各試行・replay）でも共有する。
+    同じプロセス内の作成は索引ごとに 1 つずつ（後から来た方は変更の確認だけで済む）。
+    同じような検索を繰り返すので、正規化したクエリで LRU キャッシュする。
+    """
+    SUFFIXES = (".txt", ".md", ".jsonl")
+    _build_locks = {}
+    _build_locks_guard = threading.Lock()
+
+    def __init__(self, corpus_dir, index_dir, passage_chars=500, cache_size=256):
+        self.corpus_dir = Path(corpus_dir)
+        self.db_path = self.index_path(corpus_dir, index_dir, passage_chars)
+        self.passage_chars = passage_chars
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._reader = None
+        self.ready = threading.Event()
+        self._built = threading.Event()  # 作成の成否に関わらず終わったら立つ
+        self.hits = self.misses = 0
+        threading.Thread(target=self._build, daemon=True).start()
+
+    @staticmethod
+    def index_path(corpus_dir, index_dir, passage_chars=500):
+        """コーパスの絶対パスと区切り幅ごとの索引ファイル"""
+        key = f"{Path(corpus_dir).resolve()}\0{passage_chars}"
+        return Path(index_dir) / f"search_{hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()}.db"
+
+    def wait(self, timeout=None):
+        """索引の作成（更新の確認）が終わるまで待つ。使えるなら True"""
+        self._built.wait(timeout)
+        return self.ready.is_set()
+
+    # ─── 索引作成 ───
+
+    def _passages(self, path):
+        """(title, text) を passage_chars 程度に区切って返す"""
+        if path.suffix == ".jsonl":
+            docs = []
+            with open(path, encoding="utf-8", errors="replace") as f:
+                for i, line in enumerate(f):
+                    try:
+                        d = json.loads(line)
+                    except ValueError:
+                        continue
+                    text = d.get("text") or d.get("content") if isinstance(d, dict) else None
+                    if text:
+                        docs.append((d.get("title") or f"{path.stem}#{i}", text))
+        else:
+            docs = [(path.stem, path.read_text(encoding="utf-8", errors="replace"))]
+        for title, text in docs:
+            buf = ""
+            for para in re.split(r'\n\s*\n', text):
+                para = para.strip()
+                if buf and len(buf) + len(para) > self.passage_chars:
+                    yield title, buf
+                    buf = ""
+                buf = f"{buf}\n{para}" if buf else para
+                while len(buf) > self.passage_chars * 2:
+                    yield title, buf[:self.passage_chars]
+                    buf = buf[self.passage_chars:]
+            if buf:
+                yield title, buf
+
+    def _build(self):
+        with SearchCorpus._build_locks_guard:
+            lock = SearchCorpus._build_locks.setdefault(str(self.db_path), threading.Lock())
+        try:
+            with lock:
+                self._update_index()
+        finally:
+            self._built.set()
+
+    def _update_index(self):
+        t0 = time.time()
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=60)  # 別プロセスが同じ索引を更新中なら待つ
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files(path TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+                CREATE TABLE IF NOT EXISTS passages(id INTEGER PRIMARY KEY, path TEXT, title TEXT, text TEXT);
+                CREATE INDEX IF NOT EXISTS passages_path ON passages(path);
+                CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts USING fts5(
+                    title, text, content='passages', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS passages_ai AFTER INSERT ON passages BEGIN
+                    INSERT INTO passages_fts(rowid, title, text) VALUES (new.id, new.title, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS passages_ad AFTER DELETE ON passages BEGIN
+                    INSERT INTO passages_fts(passages_fts, rowid, title, text) VALUES ('delete', old.id, old.title, old.text);
+                END;
+            """)
+            known = {p: (m, sz) for p, m, sz in conn.execute("SELECT path, mtime, size FROM files")}
+            seen, changed = set(), 0
+            files = sorted(p for p in self.corpus_dir.rglob("*") if p.suffix in self.SUFFIXES and p.is_file()) \
+                if self.corpus_dir.is_dir() else []
+            for path in files:
+                key = str(path.relative_to(self.corpus_dir))
+                seen.add(key)
+                st = path.stat()
+                if known.get(key) == (st.st_mtime, st.st_size):
+                    continue
+                with conn:
+                    conn.execute("DELETE FROM passages WHERE path = ?", (key,))
+                    conn.executemany("INSERT INTO passages(path, title, text) VALUES (?,?,?)",
+                                     ((key, title, text) for title, text in self._passages(path)))
+                    conn.execute("INSERT OR REPLACE INTO files VALUES (?,?,?)", (key, st.st_mtime, st.st_size))
+                changed += 1
+            for key in set(known) - seen:
+                with conn:
+                    conn.execute("DELETE FROM passages WHERE path = ?", (key,))
+                    conn.execute("DELETE FROM files WHERE path = ?", (key,))
+                changed += 1
+            if changed:
+                with conn:
+                    conn.execute("INSERT INTO passages_fts(passages_fts) VALUES ('optimize')")
+                print(f"[検索コーパス] {len(files)}ファイル（更新 {changed}）索引 {time.time() - t0:.1f}s")
+            conn.close()
+        except (sqlite3.Error, OSError) as e:
+            print(f"[検索コーパスエラー] {e}")
+            return
+        self.ready.set()
+
+    # ─── 検索 ───
+
+    @staticmethod
+    def _cache_key(text):
+        return re.sub(r'[\s\W_]+', '', text).lower()
+
+    def search(self, text, k=3, timeout=0.2):
+        """上位 k 件 [(title, text)]"""
+        if not self.ready.is_set():
+            return []
+        key = (self._cache_key(text), k)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+        self.misses += 1
+        q = fts_query(text)
+        if not q:
+            return []
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.db_path, check_same_thread=False, timeout=1)
+            self._reader.execute("PRAGMA mmap_size=268435456")
+        rows = fts_fetch(self._reader,
+                         "SELECT p.title, p.text FROM passages_fts f JOIN passages p ON p.id = f.rowid "
+                         "WHERE passages_fts MATCH ? ORDER BY bm25(passages_fts) LIMIT ?", (q, k), timeout)
+        if not rows:
+            return rows  # 時間切れの可能性があるので空はキャッシュしない
+        with self._cache_lock:
+            self._cache[key] = rows
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return rows
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+# ═══════════════════════════════════════════════════════════════════
+# イベント（UI への差分配信）
+# ═══════════════════════════════════════════════════════════════════
+
+class EventBus:
+    """版番号つきの変更フィード
+
+    publish のたびに seq が増える。購読側は最後に見た seq（カーソル）を持ち、
+    since(cursor) で新しい分だけ受け取る。wait は変化があるまで眠るので、待機中の購読者は CPU を使わない。
+    履歴は capacity 件のリングバッファ。poke は保存せずに起こすだけ（ストリーム途中の表示更新用）。
+    """
+
+    def __init__(self, capacity=500):
+        self._items = deque(maxlen=capacity)  # (seq, topic, data)
+        self._cond = threading.Condition()
+        self.seq = 0
+        self.pokes = 0
+
+    def publish(self, topic, data=None):
+        with self._cond:
+            self.seq += 1
+            self._items.append((self.seq, topic, data))
+            self._cond.notify_all()
+
+    def poke(self):
+        with self._cond:
+            self.pokes += 1
+            self._cond.notify_all()
+
+    def since(self, cursor):
+        """(新しいカーソル, [(seq, topic, data)])。リングから溢れた分は返らない"""
+        with self._cond:
+            items = [it for it in self._items if it[0] > cursor] if self.seq > cursor else []
+            return self.seq, items
+
+    def wait(self, cursor, pokes=None, timeout=None):
+        """seq が cursor を超えるか poke されるまで待つ。変化があれば True"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self.seq > cursor or (pokes is not None and self.pokes != pokes), timeout)
+
 
 # ═══════════════════════════════════════════════════════════════════
 # 本体
@@ -62,15 +2198,71 @@ class ISBE:
     CONFIG_FILE = Path("./autoloop_config.json")
 
     def __init__(self, api_url="http://localhost:1234", seed_text=None,
-                 log_dir="./is_be_log", compress_at_chars=75000, max_context_chars=90000):
+                 log_dir="./is_be_log", compress_at_chars=75000, max_context_chars=90000,
+                 stream=False, stop_on_tool=False, budget_unit="tokens",
+                 compress_at_tokens=36000, max_context_tokens=45000, backends=None, transport=None):
         self.api_url = api_url.rstrip("/")
         self.log_dir = Path(log_dir); self.log_dir.mkdir(exist_ok=True)
         self.compress_at_chars = compress_at_chars
         self.max_context_chars = max_context_chars
+        self.budget_unit = budget_unit    # 圧縮・上限の単位: tokens / chars
+        self.compress_at_tokens = compress_at_tokens
+        self.max_context_tokens = max_context_tokens
+        self.tokenize = "auto"            # auto: サーバーの tokenize を試す / local: 推定のみ
+        self.background_compress = True   # 圧縮を裏で走らせ、その間も思考を続ける
+        self.summarizer_url = None        # 要約専用の API（小さく速いモデル向け）
+        self.summarizer_model = None
+        self.memory_chunk_chars = 4000    # 1 回の要約で畳む古い思考の量
+        self.memory_fanout = 4            # この数の要約がたまったら上の階層へ統合
+        self.log_opts = {}                # LogWriter への追加引数（ローテーション・fsync など）
+        self.temperature = 0.85
+        self.novelty_opts = {}            # NoveltyDetector への追加引数（n, window, threshold など）
+        self.collapse_actions = ["dedupe", "temperature", "compress"]  # 崩壊検出時の介入
+        self.collapse_cooldown = 10       # 介入後、次の介入まで待つ思考数
+        self.recall_opts = {"k": 5, "chars": 800, "timeout": 0.2, "exclude_recent": 30}  # remember の検索予算
+        self.message_history = 200        # 対話パネルの履歴（リングバッファ）
+        self.pipeline = False             # 生成と後処理（ツール・ログ）を重ねる
+        self.think_interval = 0.01        # 直列時の思考と思考の間（秒）
+        self.candidates = 1               # 1 回に生成する候補数（>1 で新規性の高いものを選ぶ）
+        self.preempt = False              # 人間の声で生成中の思考を打ち切る（有効時は思考をストリームで受ける）
+        self.metrics_port = None          # /metrics を出すポート（None で出さない）
+        self.trace_opts = {"enabled": False, "capacity": 200000, "profile_seconds": 30}  # 区間の記録と cProfile
+        self.checkpoint_opts = {"every": 1, "compact_ratio": 2.0, "fsync": False}  # every=0 で無効
+        self.search_opts = {"corpus_dir": "./corpus", "index_dir": "./is_be_index",
+                            "k": 3, "chars": 600, "timeout": 0.2, "cache": 256}  # search の検索予算
+        self.stream = stream              # SSE で逐次受信する
+        self.stop_on_tool = stop_on_tool  # ツール呼び出しが完結した時点で生成を打ち切る
+        self.transport_opts = {}          # Transport への追加引数（タイムアウト・再試行など）
+        self.backends = []                # 複数サーバー: ["http://..."] か [{"url": ..., "model": ...}]
+        self.probe_interval = 10.0        # バックエンドの死活確認の間隔（秒）
+        self.capabilities = {}            # モデル名 → 対応 API（start 時に確かめて保存）
+        self.profiles = {}                # モデル名（部分一致、"*" は全体）→ max_tokens / temperature / stop / latency_budget
+        self.cache_prompt = True          # サーバーにプロンプトキャッシュを使わせる
+        self.id_slot = None               # 思考を固定するスロット番号（llama.cpp 互換）
 
         # 保存済み設定があれば上書き
         self._load_config()
 
+        # 通信（keep-alive 接続プール。複数バックエンドなら振り分け）
+        if backends:
+            self.backends = list(backends)
+        if transport is not None:  # 差し替え（再生など）— 文脈を作る前に入れる
+            self.transport = transport
+            self.api_url = transport.base_url
+        elif len(self.backends) > 1 or (self.backends and not isinstance(self.backends[0], str)):
+            self.transport = TransportPool(self.backends, self.probe_interval, **self.transport_opts)
+            self.api_url = self.transport.base_url
+        else:
+            if self.backends:
+                b = self.backends[0]
+                self.api_url = (b if isinstance(b, str) else b["url"]).rstrip("/")
+            self.transport = Transport(self.api_url, **self.transport_opts)
+        self._prompts = PromptBuilder(self.cache_prompt, self.id_slot)
+        self.tokenizer = TokenCounter(self.transport, self.tokenize)
+        self._paused_suffix_raw = self.tokenizer.raw(TOOLS_PAUSED_SUFFIX)
+        self._summary_transport = (Transport(self.summarizer_url, **self.transport_opts)
+                                   if self.summarizer_url else None)
+
         # 状態
         self.alive = False
         self.thinking = False
@@ -79,32 +2271,92 @@ class ISBE:
         self.birth = datetime.now()
         self.total_tokens_generated = 0
         self.model_name = None
+        self.partial_thought = ""  # ストリーム受信中の思考（UI表示用）
+        self._last_usage = {}      # 直近の応答の usage（トークン推定の較正に使う）
 
         # 文脈
         self.seed_text = seed_text or DEFAULT_SEED
-        self.context_text = self.seed_text
+        self.context = ContextBuffer(self.seed_text, token_counter=self.tokenizer)
         self.tool_definitions = TOOL_DEFINITIONS
 
-        # 人間との対話
-        self._human_input = None
-        self._human_event = threading.Event()
-        self._response_text = None
-        self._response_event = threading.Event()
+        # 人間との対話（呼び出しごとに Future を返す。思考中なら生成を打ち切って先に応答）
+        self._human_queue = queue.Queue()
+        self._human_event = threading.Event()  # ループを起こすだけ
+        self._cancel = threading.Event()
+        self._preemptible = False
+
+        # ツール
+        # 圧縮（裏で要約し、思考スレッドで差し替える）
+        self.memory = RollingSummarizer(self.memory_chunk_chars, self.memory_fanout)
+        self._compress_thread = None
+        self._compress_result = None
+
+        # 反復検出と介入
+        self.novelty = NoveltyDetector(**self.novelty_opts)
+        self._intervened_at = -10 ** 9
+        self._temperature_boost_until = 0
 
         # ツール
         self._tool_history = deque(maxlen=20)
         self._tools_disabled_until = 0
-        self._pending_messages = []
-        self.thought_log = []
+        self.events = EventBus()
+        self._pending_messages = deque(maxlen=self.message_history)
+        self.thought_log = deque(maxlen=100)
 
         # ディレクトリ
         # (is_be_articles は廃止)
 
         # ログ（モデル名はstart時に確定してリネーム）
-        self._log_ts = self.birth.strftime('%Y%m%d_%H%M%S')
-        self.log_file = self.log_dir / f"full_{self._log_ts}.jsonl"
-        self.dialog_log_file = self.log_dir / f"dialog_{self._log_ts}.jsonl"
-        self._thought_durations = []
+        self.memory_store = MemoryStore(self.log_dir)
+        # search の検索先（search(text, k, timeout) → [(title, text)] を持つものなら差し替え可）
+        self.search_backend = SearchCorpus(self.search_opts["corpus_dir"], self.search_opts["index_dir"],
+                                           cache_size=self.search_opts["cache"]) if self.search_opts.get("corpus_dir") else None
+        self.tracer = Tracer(self.trace_opts["enabled"], self.trace_opts["capacity"])
+        self._log_writer = self._dialog_writer = None
+        self._new_log_session(self.birth)
+        self._local = threading.local()
+        self._caps = {}          # 使用中モデルの能力（不明なら空＝従来どおり試す）
+        self._cap_failures = 0   # 能力の記録と食い違った連続回数
+        self._tps_ewma = None    # 思考の実測 tok/s（max_tokens の調整用）
+        self._post_pool = None
+        self._pending_job = None
+        self._journal = None
+        self._cassette = None    # record_to の書き先（ループの終わりに閉じる）
+        self._ckpt_mark = None  # (context.epoch, context.appends, thought_count, context.version, 最後に書いた thought_log の n)
+        self.metrics = self._make_metrics()
+
+    @property
+    def context_text(self):
+        """描画済みの文脈（変更がなければキャッシュ）"""
+        return self.context.render()
+
+    @context_text.setter
+    def context_text(self, text):
+        self.context.reset(text)
+
+    # ─── 文脈の予算 ───
+
+    def _budget(self):
+        """(圧縮開始, 最大) を現在の単位で返す"""
+        if self.budget_unit == "tokens":
+            return self.compress_at_tokens, self.max_context_tokens
+        return self.compress_at_chars, self.max_context_chars
+
+    def _context_size(self):
+        return self.context.size(self.budget_unit)
+
+    def _needs_compress(self):
+        return self._context_size() > self._budget()[0]
+
+    def _enforce_max(self):
+        """最大サイズを超えていれば古い区画から退避（圧縮が追いつかない時の安全弁）
+
+        トークン単位でも max_context_chars は上限として守る（推定が外れても文字数で頭打ちにする）。
+        """
+        for unit, limit in ((self.budget_unit, self._budget()[1]), ("chars", self.max_context_chars)):
+            if self.context.size(unit) > limit:
+                removed = self.context.truncate_front(limit, unit)
+                self._log("truncate", "", {"removed": removed, "unit": unit})
 
     # ─── 設定の永続化 ───
 
@@ -115,26 +2367,96 @@ class ISBE:
                     cfg = json.load(f)
                 self.compress_at_chars = cfg.get("compress_at_chars", self.compress_at_chars)
                 self.max_context_chars = cfg.get("max_context_chars", self.max_context_chars)
-                print(f"[設定読込] 圧縮:{self.compress_at_chars:,} 最大:{self.max_context_chars:,}")
+                # 単位のない古い設定は文字数で保存されたもの（保存した上限をそのまま使う）
+                legacy = "compress_at_chars" in cfg or "max_context_chars" in cfg
+                self.budget_unit = cfg.get("budget_unit", "chars" if legacy else self.budget_unit)
+                self.compress_at_tokens = cfg.get("compress_at_tokens", self.compress_at_tokens)
+                self.max_context_tokens = cfg.get("max_context_tokens", self.max_context_tokens)
+                self.tokenize = cfg.get("tokenize", self.tokenize)
+                self.background_compress = cfg.get("background_compress", self.background_compress)
+                self.summarizer_url = cfg.get("summarizer_url", self.summarizer_url)
+                self.summarizer_model = cfg.get("summarizer_model", self.summarizer_model)
+                self.memory_chunk_chars = cfg.get("memory_chunk_chars", self.memory_chunk_chars)
+                self.memory_fanout = cfg.get("memory_fanout", self.memory_fanout)
+                self.log_opts = cfg.get("log", self.log_opts)
+                self.temperature = cfg.get("temperature", self.temperature)
+                self.novelty_opts = cfg.get("novelty", self.novelty_opts)
+                self.collapse_actions = cfg.get("collapse_actions", self.collapse_actions)
+                self.collapse_cooldown = cfg.get("collapse_cooldown", self.collapse_cooldown)
+                self.recall_opts = dict(self.recall_opts, **cfg.get("recall", {}))
+                self.search_opts = dict(self.search_opts, **cfg.get("search", {}))
+                self.message_history = cfg.get("message_history", self.message_history)
+                self.preempt = cfg.get("preempt", self.preempt)
+                self.pipeline = cfg.get("pipeline", self.pipeline)
+                self.think_interval = cfg.get("think_interval", self.think_interval)
+                self.candidates = cfg.get("candidates", self.candidates)
+                self.checkpoint_opts = dict(self.checkpoint_opts, **cfg.get("checkpoint", {}))
+                self.metrics_port = cfg.get("metrics_port", self.metrics_port)
+                self.trace_opts = dict(self.trace_opts, **cfg.get("trace", {}))
+                self.stream = cfg.get("stream", self.stream)
+                self.stop_on_tool = cfg.get("stop_on_tool", self.stop_on_tool)
+                self.transport_opts = cfg.get("transport", self.transport_opts)
+                self.backends = cfg.get("backends", self.backends)
+                self.probe_interval = cfg.get("probe_interval", self.probe_interval)
+                self.capabilities = cfg.get("capabilities", self.capabilities)
+                self.profiles = cfg.get("profiles", self.profiles)
+                self.cache_prompt = cfg.get("cache_prompt", self.cache_prompt)
+                self.id_slot = cfg.get("id_slot", self.id_slot)
+                c, m = self._budget()
+                print(f"[設定読込] 圧縮:{c:,} 最大:{m:,} ({self.budget_unit})")
             except Exception as e:
                 print(f"[設定読込エラー] {e}")
 
-    def save_config(self):
-        cfg = {
-            "compress_at_chars": self.compress_at_chars,
-            "max_context_chars": self.max_context_chars,
-        }
+    UI_KEYS = ("budget_unit", "compress_at_chars", "max_context_chars", "compress_at_tokens", "max_context_tokens")
+
+    def save_config(self):
+        """UI で変えられる文脈の予算だけを設定ファイルに書き足す（CLI の指定や実行中の状態は書かない）"""
+        try:
+            cfg = {}
+            if self.CONFIG_FILE.exists():
+                with open(self.CONFIG_FILE, "r", encoding="utf-8") as f:
+                    cfg = json.load(f)
+            cfg.update({k: getattr(self, k) for k in self.UI_KEYS})
+            self._write_config(cfg)
+        except Exception as e:
+            print(f"[設定保存エラー] {e}")
+
+    def _save_capabilities(self):
+        """能力の記録だけを設定ファイルに書き足す（CLI の指定や実行中の状態は書かない）"""
         try:
-            with open(self.CONFIG_FILE, "w", encoding="utf-8") as f:
-                json.dump(cfg, f, ensure_ascii=False, indent=2)
+            cfg = {}
+            if self.CONFIG_FILE.exists():
+                with open(self.CONFIG_FILE, "r", encoding="utf-8") as f:
+                    cfg = json.load(f)
+            cfg["capabilities"] = dict(cfg.get("capabilities") or {}, **self.capabilities)
+            self._write_config(cfg)
         except Exception as e:
             print(f"[設定保存エラー] {e}")
 
+    def _write_config(self, cfg):
+        """一時ファイルに書いて置き換える（同じ設定を書く複数のプロセスが壊れたファイルを残さない）"""
+        tmp = self.CONFIG_FILE.with_name(f"{self.CONFIG_FILE.name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cfg, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.CONFIG_FILE)
+
     # ─── 接続 ───
 
     def check_connection(self):
+        if isinstance(getattr(self.transport, "inner", self.transport), TransportPool):
+            n = self.transport.probe()
+            for b in self.transport.backends:
+                mark = "OK" if b.healthy else f"✖ {b.last_error}"
+                print(f"[{self._ts()}] {b.url} — {b.model or '-'} {mark}")
+            self.model_name = self.transport.primary_model()
+            self.transport.start_probing()
+            if n:
+                print(f"[{self._ts()}] 接続OK — {n}/{len(self.transport.backends)} バックエンド")
+                return True
+            print(f"[{self._ts()}] ✖ 全バックエンドに接続できません")
+            return False
         try:
-            r = requests.get(f"{self.api_url}/v1/models", timeout=5)
+            r = self.transport.get("/v1/models", read_timeout=5)
             data = r.json()
             if data.get("data"):
                 self.model_name = data["data"][0]["id"]
@@ -145,88 +2467,398 @@ class ISBE:
             print(f"[{self._ts()}] ✖ 接続エラー: {e}")
         return False
 
+    # ─── 記録と再生 ───
+
+    def record_to(self, path=None):
+        """以後の送受信（思考・要約・tokenize・接続確認）をカセットに書き足す"""
+        path = Path(path) if path else self.log_dir / f"cassette_{self._log_ts}.jsonl"
+        self._cassette = cassette = Cassette(path, {"base_url": self.api_url, "seed": self.seed_text})
+        self.transport = RecordingTransport(self.transport, cassette)
+        if self._summary_transport:
+            self._summary_transport = RecordingTransport(self._summary_transport, cassette)
+        self.tokenizer.transport = self.transport
+        print(f"[{self._ts()}] 📼 記録: {path}")
+        return path
+
+    def replay_from(self, source, latency=0.0):
+        """カセット（パスか、コンストラクタに渡した ReplayTransport）の応答で動かす（サーバー不要）
+
+        latency は録った待ち時間の倍率。
+        """
+        if isinstance(source, ReplayTransport):
+            self.transport = source
+        else:
+            self.transport = ReplayTransport(Cassette.load(source), latency)
+        cassette = self.transport.cassette
+        self.transport.tag = lambda: self.thought_count
+        if self._summary_transport:
+            self._summary_transport = self.transport  # 照合の状態を共有する
+        self.tokenizer.transport = self.transport
+        self.api_url = self.transport.base_url
+        print(f"[{self._ts()}] 📼 再生: {cassette.path.name}（{len(cassette.entries)} 要求）")
+        return cassette
+
     # ─── 生成（completions API）───
 
-    def _complete(self, prompt, max_tokens=256, temperature=0.85):
-        """テキスト補完 — 文脈の「続き」を生成"""
+    def _complete(self, prompt, max_tokens=256, temperature=0.85, hints=None, via=None):
+        """テキスト補完 — 文脈の「続き」を生成
+
+        via=(transport, model) を渡すと別経路（要約など）で送る。その場合はストリームせず、
+        思考スレッドの状態（partial_thought, _last_usage）にも触れない。
+        """
+        transport, model = via or (self.transport, self.model_name)
         payload = {"prompt": prompt, "max_tokens": max_tokens, "temperature": temperature,
                    "top_p": 0.9, "repeat_penalty": 1.15, "stream": False}
-        if self.model_name: payload["model"] = self.model_name
-        r = requests.post(f"{self.api_url}/v1/completions", json=payload, timeout=300)
-        data = r.json()
+        if model: payload["model"] = model
+        if hints: payload.update(hints)
+        if (self.stream or self._preemptible) and not via and self._caps.get("stream", True):
+            return self._stream("/v1/completions", payload, lambda ch: ch.get("text"))
+        with self.tracer.span("http.generate", path="/v1/completions"):
+            r = transport.post("/v1/completions", payload)
+            data = r.json()
+        if not via: self._last_usage = data.get("usage") or {}
         return data["choices"][0]["text"].strip(), data.get("usage", {}).get("completion_tokens", 0)
 
-    def _chat_fallback(self, prompt, max_tokens=256, temperature=0.85):
+    def _chat_fallback(self, prompt, max_tokens=256, temperature=0.85, hints=None, via=None):
         """chat API フォールバック"""
-        messages = [
+        transport, model = via or (self.transport, self.model_name)
+        payload = {"messages": self._chat_messages(prompt), "max_tokens": max_tokens, "temperature": temperature,
+                   "top_p": 0.9, "repeat_penalty": 1.15, "stream": False}
+        if model: payload["model"] = model
+        if hints: payload.update(hints)
+        if (self.stream or self._preemptible) and not via and self._caps.get("stream", True):
+            return self._stream("/v1/chat/completions", payload,
+                                lambda ch: (ch.get("delta") or {}).get("content"))
+        with self.tracer.span("http.generate", path="/v1/chat/completions"):
+            r = transport.post("/v1/chat/completions", payload)
+            data = r.json()
+        if not via: self._last_usage = data.get("usage") or {}
+        return data["choices"][0]["message"]["content"].strip(), data.get("usage", {}).get("completion_tokens", 0)
+
+    @staticmethod
+    def _chat_messages(prompt):
+        return [
             {"role": "system", "content": "あなたは自律思考システムである。以下の文脈の続きを自由に生成せよ。回答ではなく、思考の続きだ。"},
             {"role": "user", "content": prompt}
         ]
-        payload = {"messages": messages, "max_tokens": max_tokens, "temperature": temperature,
-                   "top_p": 0.9, "repeat_penalty": 1.15, "stream": False}
-        if self.model_name: payload["model"] = self.model_name
-        r = requests.post(f"{self.api_url}/v1/chat/completions", json=payload, timeout=300)
-        data = r.json()
-        return data["choices"][0]["message"]["content"].strip(), data.get("usage", {}).get("completion_tokens", 0)
 
-    def _generate(self, prompt, max_tokens=256, temperature=0.85):
-        """生成 — completions優先、chatフォールバック"""
+    def _stream(self, path, payload, pick):
+        """SSE 受信 — トークンを逐次追加し、ツール呼び出しの完結を検出（設定時はそこで打ち切り）
+
+        _cancel が立てば次のチャンクで受信をやめる（接続を閉じればサーバー側の生成も止まる）。
+        """
+        payload = dict(payload, stream=True)
+        scanner = ToolScanner()
+        chunks, usage_tokens = 0, None
+        self.partial_thought = ""
+        self._last_usage = {}
+        t0 = time.perf_counter_ns()
+        r = self.transport.post(path, payload, stream=True)
+        t_head = t_first = time.perf_counter_ns()
         try:
-            return self._complete(prompt, max_tokens, temperature)
+            # バイト列のまま行分割して UTF-8 で復号（text/event-stream は requests だと latin-1 扱いになり、
+            # 日本語の 0x85 が改行とみなされて行が割れる）
+            for raw in r.iter_lines(chunk_size=None):
+                line = raw.decode("utf-8", errors="replace")
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    continue  # 残りを読み切って接続をプールへ戻す
+                if self._cancel.is_set():
+                    break
+                event = json.loads(data)
+                if event.get("usage"):
+                    self._last_usage = event["usage"]
+                    usage_tokens = event["usage"].get("completion_tokens", usage_tokens)
+                choices = event.get("choices") or []
+                delta = pick(choices[0]) if choices else None
+                if not delta:
+                    continue
+                chunks += 1
+                if chunks == 1:
+                    t_first = time.perf_counter_ns()
+                spans = scanner.feed(delta)
+                self.partial_thought = scanner.text
+                self.events.poke()
+                if spans and self.stop_on_tool:
+                    # ツール呼び出し以降のトークンは捨てる（生成も止める）
+                    scanner.text = scanner.text[:spans[-1].end()]
+                    break
+        finally:
+            r.close()
+        if self.tracer.enabled:
+            # 接続〜応答ヘッダ / 最初のトークンまで（プリフィル）/ 残りのトークン（デコード）
+            t_end = time.perf_counter_ns()
+            self.tracer.complete("http.connect", t0, t_head, {"path": path})
+            self.tracer.complete("http.prefill", t_head, t_first)
+            self.tracer.complete("http.decode", t_first, t_end, {"chunks": chunks, "cancelled": self._cancel.is_set()})
+        # 打ち切り時は usage が来ないので受信チャンク数で近似
+        return scanner.text.strip(), usage_tokens if usage_tokens is not None else chunks
+
+    def _generate(self, prompt, max_tokens=256, temperature=0.85, hints=None, via=None):
+        """生成 — completions優先、chatフォールバック。chat 専用と分かっているモデルには最初から chat"""
+        caps = self.capabilities.get(via[1], {}) if via else self._caps
+        if caps.get("completions") is False and caps.get("chat"):
+            try:
+                result = self._chat_fallback(prompt, max_tokens, temperature, hints, via)
+            except Exception:
+                self._capability_miss(via)
+                raise
+            if not via:
+                self._cap_failures = 0
+            return result
+        try:
+            result = self._complete(prompt, max_tokens, temperature, hints, via)
+        except requests.ReadTimeout:
+            raise  # 固まったサーバーに chat でもう一度 read_timeout 待たない
         except Exception:
-            return self._chat_fallback(prompt, max_tokens, temperature)
+            self.metrics.inc("chat_fallback_total")
+            if caps.get("completions"):
+                self._capability_miss(via)
+            return self._chat_fallback(prompt, max_tokens, temperature, hints, via)
+        if not via:
+            self._cap_failures = 0
+        return result
+
+    # ─── 複数候補 ───
+
+    def _sample_best(self, prompt, n, max_tokens, temperature, hints, paused):
+        """同じプロンプトから n 候補を生成し、最も良いものを選ぶ
+
+        まず n パラメータで 1 リクエスト（プリフィルを共有）。サーバーが n を無視したら以後は
+        同じプロンプトの並列リクエストで補う。戻り値は (本文, トークン数, 全候補の合計トークン, 落選候補の統計)。
+        1 リクエストの n 候補は候補ごとのトークン数が分からないので、統計では None（不明）にする。
+        """
+        cands, spent = [], 0
+        if self._caps.get("n", True):
+            try:
+                cands, spent = self._request_n(prompt, n, max_tokens, temperature, hints)
+                if len(cands) < n:
+                    self._caps["n"] = False  # 応答はあったが n を無視した（一時的な失敗では決めない）
+            except Exception:
+                cands, spent = [], 0
+        if len(cands) < n:
+            side = {k: v for k, v in hints.items() if k != "id_slot"}  # 同じスロットに並べると直列になる
+            via = (self.transport, self.model_name)
+            with ThreadPoolExecutor(max_workers=n - len(cands)) as ex:
+                futures = [ex.submit(self._generate, prompt, max_tokens, temperature, side, via)
+                           for _ in range(n - len(cands))]
+                for f in futures:
+                    try:
+                        text, tok = f.result()
+                    except Exception:
+                        continue
+                    cands.append((text, tok))
+                    spent += tok
+        cands = [(text, tok) for text, tok in cands if text]
+        if not cands:
+            return "", 0, 0, []
+
+        last = next((seg for seg in reversed(self.context.segments) if seg.kind == "thought"), None)
+        extra = ngram_hashes(last.text, self.novelty.n) if last else frozenset()
+        scored = []
+        tracing = self.tracer.enabled
+        t0 = time.perf_counter_ns() if tracing else 0
+        for text, tok in cands:
+            novelty = self.novelty.peek(text, extra)
+            risk = self._tool_loop_risk(text, paused)
+            scored.append((novelty - 0.5 * risk, novelty, risk, text, tok))
+        best = max(range(len(scored)), key=lambda i: scored[i][0])
+        if tracing:
+            self.tracer.complete("think.select", t0, time.perf_counter_ns(), {"n": len(scored)})
+        rejected = [{"score": round(sc, 3), "novelty": round(nv, 3), "risk": round(rk, 3), "ch": len(t), "tok": tk}
+                    for i, (sc, nv, rk, t, tk) in enumerate(scored) if i != best]
+        self.metrics.inc("candidates_total", len(scored))
+        _, _, _, text, tok = scored[best]
+        return text, tok if tok is not None else self.tokenizer.estimate(text), spent, rejected
+
+    def _request_n(self, prompt, n, max_tokens, temperature, hints):
+        """n 候補を 1 リクエストで（completions、chat 専用なら chat）— ([(本文, None)], 全候補の合計トークン)"""
+        chat = self._caps.get("completions") is False and self._caps.get("chat")
+        payload = {"max_tokens": max_tokens, "temperature": temperature, "top_p": 0.9,
+                   "repeat_penalty": 1.15, "stream": False, "n": n}
+        if chat:
+            payload["messages"] = self._chat_messages(prompt)
+        else:
+            payload["prompt"] = prompt
+        if self.model_name: payload["model"] = self.model_name
+        if hints: payload.update(hints)
+        with self.tracer.span("http.generate", n=n):
+            r = self.transport.post("/v1/chat/completions" if chat else "/v1/completions", payload)
+            data = r.json()
+        self._last_usage = data.get("usage") or {}
+        texts = [(ch["message"]["content"] if chat else ch["text"]).strip() for ch in data.get("choices") or []]
+        total = self._last_usage.get("completion_tokens")
+        if total is None:
+            total = sum(self.tokenizer.estimate(t) for t in texts)
+        return [(t, None) for t in texts], total
+
+    def _tool_loop_risk(self, text, paused):
+        """ツールの連続呼び出しに入りそうな度合い — 一時停止に触れる呼び出し・停止中の呼び出し・呼び出しの比率"""
+        calls = self._parse_tools(text)
+        if not calls:
+            return 0.0
+        recent = [h["type"] for h in list(self._tool_history)[-2:]]
+        risk = sum(1.0 for name, _ in calls if len(recent) == 2 and all(t == name for t in recent))
+        if paused:
+            risk += 1.0
+        markup = sum(len(m.group(0)) for m in TOOL_PATTERN.finditer(text)) + \
+            sum(len(m.group(0)) for m in TOOL_CALL_PATTERN.finditer(text))
+        return risk + markup / max(1, len(text))
+
+    # ─── 能力の確認とモデル別設定 ───
+
+    def probe_capabilities(self, force=False):
+        """completions / chat / stream / tokenize / cache_prompt の対応を確かめ、モデルごとに保存
+
+        保存済みなら問い合わせない（force で再確認）。失敗する経路へ毎回送らずに済む。
+        """
+        model = self.model_name or "unknown"
+        caps = self.capabilities.get(model)
+        if caps and not force:
+            self._apply_capabilities(caps)
+            return caps
+        t0 = time.time()
+        base = {"max_tokens": 1, "temperature": 0}
+        if self.model_name: base["model"] = self.model_name
+
+        def send(path, payload, stream=False):
+            try:
+                return self.transport.post(path, payload, stream=stream, read_timeout=60, retries=0)
+            except requests.RequestException:
+                return None
+
+        def answered(r):
+            try:
+                return r is not None and bool(r.json().get("choices"))
+            except ValueError:
+                return False
+
+        caps = {}
+        r = send("/v1/completions", dict(base, prompt="。", cache_prompt=True))
+        caps["cache_prompt"] = answered(r)
+        caps["completions"] = caps["cache_prompt"] or answered(send("/v1/completions", dict(base, prompt="。")))
+        caps["chat"] = answered(send("/v1/chat/completions",
+                                     dict(base, messages=[{"role": "user", "content": "。"}])))
+        path, body = (("/v1/completions", dict(base, prompt="。")) if caps["completions"] else
+                      ("/v1/chat/completions", dict(base, messages=[{"role": "user", "content": "。"}])))
+        r = send(path, dict(body, stream=True), stream=True)
+        caps["stream"] = r is not None and r.headers.get("content-type", "").startswith("text/event-stream")
+        if r is not None: r.close()
+        r = send("/tokenize", {"content": "テスト"})
+        try:
+            caps["tokenize"] = r is not None and ("tokens" in r.json() or "count" in r.json())
+        except ValueError:
+            caps["tokenize"] = False
+        caps["probed"] = datetime.now().isoformat(timespec="seconds")
+
+        self.capabilities[model] = caps
+        self._save_capabilities()
+        self._apply_capabilities(caps)
+        flags = " ".join(f"{k}{'✓' if v else '✗'}" for k, v in caps.items() if k != "probed")
+        print(f"[{self._ts()}] 🔎 {model}: {flags} ({time.time() - t0:.1f}s)")
+        self._log("capabilities", model, caps)
+        return caps
+
+    def _apply_capabilities(self, caps):
+        self._caps = caps
+        self._cap_failures = 0
+        self.tokenizer.remote = caps.get("tokenize")
+        if not caps.get("cache_prompt", True):
+            self._prompts.cache_prompt = False
+            self._prompts.id_slot = None
+
+    def _capability_miss(self, via):
+        """記録と違う失敗が続いたら、次の生成の前に確かめ直す（思考側の経路のみ）"""
+        if via:
+            return
+        self._cap_failures += 1
+        if self._cap_failures >= 3:
+            print(f"[{self._ts()}] 🔎 能力の記録と食い違う失敗が続いたので再確認")
+            self.probe_capabilities(force=True)
+
+    def _profile(self):
+        """使用中モデルの生成設定 — 既定 ← "*" ← モデル名に含まれるキー の順に上書き"""
+        p = {"max_tokens": 256, "temperature": self.temperature, "stop": None,
+             "latency_budget": None, "min_tokens": 64}
+        p.update(self.profiles.get("*", {}))
+        for key, prof in self.profiles.items():
+            if key != "*" and self.model_name and key in self.model_name:
+                p.update(prof)
+        return p
+
+    def _thought_max_tokens(self, prof):
+        """latency_budget（秒）があれば実測 tok/s から1回の長さを決める"""
+        if prof["latency_budget"] and self._tps_ewma:
+            return max(prof["min_tokens"], min(prof["max_tokens"], int(self._tps_ewma * prof["latency_budget"])))
+        return prof["max_tokens"]
+
+    def _summary_via(self):
+        """要約の送り先 — 専用バックエンドが設定されていればそちら"""
+        return (self._summary_transport or self.transport, self.summarizer_model or self.model_name)
 
     # ─── ツール処理（テキストパターン）───
 
-    def _process_tools(self, text):
-        """テキスト内のツール呼び出しを検出・実行（両形式対応）"""
-        tool_calls = []
+    @staticmethod
+    def _parse_tools(text):
+        """テキスト内のツール呼び出しを検出（両形式対応）— [(name, content), ...]"""
+        calls = []
 
         # 形式1: [TOOL:name:content]
-        pattern1 = r'\[TOOL:(\w+):([^\]]+)\]'
-        for match in re.finditer(pattern1, text):
-            name = match.group(1)
-            content = match.group(2)
-            result = self._execute_tool(name, content)
-            tool_calls.append({"name": name, "content": content, "result": result})
+        for match in TOOL_PATTERN.finditer(text):
+            calls.append((match.group(1), match.group(2)))
 
         # 形式2: <tool_call>{"name": "xxx", "arguments": {...}}</tool_call>
-        pattern2 = r'<tool_call>\s*(\{.*?\})\s*</tool_call>'
-        for match in re.finditer(pattern2, text, re.DOTALL):
+        for match in TOOL_CALL_PATTERN.finditer(text):
             try:
                 call = json.loads(match.group(1))
-                name = call.get("name", "")
+                name = str(call.get("name", ""))  # モデルの出力なので型は保証されない
                 args = call.get("arguments", {})
                 # argumentsの最初の値をcontentとして取る
                 content = next(iter(args.values()), "") if args else ""
-                result = self._execute_tool(name, content)
-                tool_calls.append({"name": name, "content": content, "result": result})
-            except (json.JSONDecodeError, StopIteration):
+                calls.append((name, content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)))
+            except (json.JSONDecodeError, StopIteration, AttributeError):
                 pass
 
-        return text, tool_calls
+        return calls
+
+    def _run_tools(self, job):
+        """検出した呼び出しを順に実行
 
-    def _execute_tool(self, name, content):
+        ツール履歴と一時停止は job に積むだけで、共有の状態へは合流時（思考スレッド）に反映する。
+        パイプラインでは worker がここを走らせている間に、思考スレッドが次の候補の評価で履歴を読む。
+        """
+        job["tool_history"] = []
+        results = []
+        for name, content in job["calls"]:
+            with self.tracer.span(f"tool.{name}"):
+                results.append({"name": name, "content": content, "result": self._execute_tool(name, content, job)})
+        return results
+
+    def _execute_tool(self, name, content, job):
         """ツール実行"""
         # 同じツール3回連続で一時停止
-        recent = [h["type"] for h in list(self._tool_history)[-3:]]
+        recent = [h["type"] for h in (list(self._tool_history) + job["tool_history"])[-3:]]
         if len(recent) >= 3 and all(t == name for t in recent):
-            self._tools_disabled_until = self.thought_count + 5
+            job["tools_disabled_until"] = self._n() + 5
             return ""
 
-        self._tool_history.append({
+        job["tool_history"].append({
             "type": name,
             "content": content[:50],
-            "thought": self.thought_count
+            "thought": self._n()
         })
+        self.metrics.inc("tool_calls_total", tool=name if name in TOOL_NAMES else "other")  # 系列数を固定
 
         if name == "search":
-            self._log("search", content, {"query": content})
+            result = self._search(content)
+            self._log("search", content, {"query": content, "found": bool(result)})
             print(f"\033[33m  🔍 検索: {content[:60]}\033[0m")
-            return ""
+            return result
 
         elif name == "message":
-            self._pending_messages.append({"content": content, "time": datetime.now().isoformat()})
+            self.post_message(content)
             print(f"\033[35m  💬 → {content[:80]}\033[0m")
             self._log("message_sent", content, {"length": len(content)})
             return ""
@@ -234,7 +2866,7 @@ class ISBE:
         elif name == "remember":
             self._log("remember", content)
             print(f"\033[36m  🧠 記憶: {content[:60]}\033[0m")
-            return ""
+            return self._recall(content)
 
         elif name == "feel":
             self._log("feel", content)
@@ -244,88 +2876,377 @@ class ISBE:
         self._log("tool_unknown", content, {"tool": name})
         return ""
 
+    def _recall(self, query):
+        """記憶索引から想起 — 文字予算内に収める。見つからなければ空（固定文を注入しない）"""
+        r = self.recall_opts
+        with self.tracer.span("tool.recall_search"):
+            hits = self.memory_store.search(query, k=r["k"], timeout=r["timeout"], exclude_session=self._log_ts,
+                                            exclude_after=self._n() - r["exclude_recent"])
+        lines, budget = [], r["chars"]
+        per_hit = max(80, r["chars"] // max(1, len(hits)))
+        for kind, n, session, content in hits:
+            text = content.replace("\n", " ")[:min(per_hit, budget)]
+            if not text:
+                break
+            lines.append(f"- {text}")
+            budget -= len(text)
+        return "[想起]\n" + "\n".join(lines) if lines else ""
+
+    def _search(self, query):
+        """検索コーパスから — 文字予算内に収める。見つからなければ空"""
+        if self.search_backend is None:
+            return ""
+        cfg = self.search_opts
+        with self.tracer.span("tool.corpus_search"):
+            hits = self.search_backend.search(query, k=cfg["k"], timeout=cfg["timeout"])
+        lines, budget = [], cfg["chars"]
+        per_hit = max(80, cfg["chars"] // max(1, len(hits)))
+        for title, text in hits:
+            text = text.replace("\n", " ")[:min(per_hit, budget)]
+            if not text:
+                break
+            lines.append(f"- {title}: {text}")
+            budget -= len(text)
+        return f"[検索: {query[:40]}]\n" + "\n".join(lines) if lines else ""
+
     # ─── 自律思考 ───
 
     def _think_once(self):
+        """1思考（直列）— 生成 → 文脈へ追加 → ツール・表示 → 結果の合流・ログ"""
+        self.thinking = True
+        try:
+            with self.tracer.span("think.generate"):
+                job = self._generate_thought()
+            if job:
+                self._finish_thought(job)
+                self._merge_thought(job)
+            self._checkpoint()
+        except Exception as e:
+            self._think_error(e)
+        finally:
+            self._think_done()
+
+    def _think_pipelined(self):
+        """1思考（パイプライン）— 後処理は worker に任せ、GPU を待たせない
+
+        思考 N を文脈に追加したら、すぐ N+1 の生成を送る。その間に worker が N のツール実行と表示を
+        行う。N の結果とログ、ツール履歴・新規性の更新は N+1 を文脈に追加した直後に合流させる（必ず待つので、
+        文脈の並びはタイミングによらず「N, N+1, N の結果」に決まる。KV キャッシュの先頭も崩れない）。
+        worker が書く共有の状態は thought_log だけなので、チェックポイントは worker が空いている合流直後に取る。
+        """
         self.thinking = True
+        try:
+            job = None
+            try:
+                with self.tracer.span("think.generate"):
+                    job = self._generate_thought()
+            finally:
+                self._drain_pipeline()
+            self._checkpoint()
+            if job:
+                job["future"] = self._post_worker().submit(self._finish_thought, job)
+                self._pending_job = job
+        except Exception as e:
+            self._think_error(e)
+        finally:
+            self._think_done()
+
+    def _post_worker(self):
+        if self._post_pool is None:
+            self._post_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="isbe-post")
+        return self._post_pool
+
+    def _drain_pipeline(self):
+        """worker に渡した思考を待って合流させる（人間への応答・停止の前にも呼ぶ）"""
+        job, self._pending_job = self._pending_job, None
+        if job:
+            with self.tracer.span("think.drain", n=job["n"]):
+                job["future"].result()
+            self._merge_thought(job)
+
+    def _drain_safely(self):
+        try:
+            self._drain_pipeline()
+        except Exception as e:
+            self._think_error(e)
+
+    def _think_error(self, e):
+        self.metrics.inc("errors_total", where="think")
+        print(f"\033[31m[エラー] {e}\033[0m")
+        # 固定待ちではなく、ブレーカー残り時間か連続失敗に応じたバックオフ
+        time.sleep(self.transport.retry_after() or self.transport.backoff(1))
+
+    def _think_done(self):
+        self.thinking = False
+        if self.partial_thought:
+            self.partial_thought = ""
+            self.events.poke()
+
+    def _generate_thought(self):
+        """生成して文脈に追加するまで（思考スレッド）。後処理に渡す job を返す"""
         t_start = time.time()
+        self._await_compression_if_full()
+        self._enforce_max()
+
+        # ツール一時停止中は定義を消さず（プレフィックスを壊さず）末尾で知らせる
+        paused = self.thought_count < self._tools_disabled_until
+        with self.tracer.span("think.prompt"):
+            prompt = self._prompts.build(self.context_text, TOOLS_PAUSED_SUFFIX if paused else "")
+        prompt_raw = self.context.raw + (self._paused_suffix_raw if paused else 0)  # 較正用（全体を数え直さない）
 
+        # 先に preemptible を立ててから待ち行列を見る（speak_async と逆順なので取りこぼさない）
+        self._cancel.clear()
+        self._preemptible = self.preempt and self.candidates <= 1  # 複数候補はストリームしない
+        if not self._human_queue.empty():
+            return None
+        prof = self._profile()
+        hints = self._prompts.hints()
+        if prof["stop"]:
+            hints = dict(hints, stop=prof["stop"])
+        rejected = None
         try:
-            # ツール一時停止中はツール定義を除去
-            if self.thought_count < self._tools_disabled_until:
-                prompt = self.context_text.replace(self.tool_definitions, "")
+            if self.candidates > 1:
+                new_text, tokens, spent, rejected = self._sample_best(
+                    prompt, self.candidates, self._thought_max_tokens(prof),
+                    self._current_temperature(prof["temperature"]), hints, paused)
             else:
-                prompt = self.context_text
-
-            new_text, tokens = self._generate(prompt, max_tokens=256, temperature=0.85)
+                new_text, tokens = self._generate(prompt, max_tokens=self._thought_max_tokens(prof),
+                                                  temperature=self._current_temperature(prof["temperature"]),
+                                                  hints=hints)
+                spent = tokens
+        finally:
+            self._preemptible = False
 
-            if not new_text:
-                return
+        if self._cancel.is_set():
+            # 人間の声を優先。途中までの思考は文脈に入れない
+            self._log("preempt", new_text, {"dt": round(time.time() - t_start, 2), "tok": tokens})
+            self.metrics.inc("preempted_total")
+            print(f"\033[2m  ⏸ 思考を中断（人間の声）\033[0m")
+            return None
+        if not new_text:
+            return None
 
-            self.thought_count += 1
-            self.total_tokens_generated += tokens
-            t_elapsed = time.time() - t_start
-            self._thought_durations.append(t_elapsed)
-            tokens_per_sec = tokens / t_elapsed if t_elapsed > 0 else 0
+        self.thought_count += 1
+        self.total_tokens_generated += spent
+        if self._last_usage.get("prompt_tokens"):
+            self.tokenizer.calibrate(prompt_raw, self._last_usage["prompt_tokens"])
+        elif not self.tokenizer.calibrated or self.thought_count % 20 == 0:
+            self.tokenizer.sample(prompt)  # usage が返らないサーバー
+        t_elapsed = time.time() - t_start
+        # 速度は選んだ 1 本で測る（複数候補の合計だと latency_budget が候補数倍ずれる）
+        tokens_per_sec = tokens / t_elapsed if t_elapsed > 0 else 0
+        if tokens >= 8:
+            self._tps_ewma = tokens_per_sec if self._tps_ewma is None else 0.8 * self._tps_ewma + 0.2 * tokens_per_sec
+        m = self.metrics
+        m.inc("thoughts_total"); m.inc("tokens_generated_total", spent)
+        m.observe("generation_seconds", t_elapsed); m.observe("tokens_per_second", tokens_per_sec)
+        m.observe("prompt_chars", len(prompt))
+        if self.context.tokens: m.observe("prompt_tokens", self.context.tokens)
 
-            # ツール処理
-            processed_text, tool_calls = self._process_tools(new_text)
+        # 文脈に追加（ツールの実行と結果の合流は後段）
+        self.context.append("thought", new_text + "\n")
+        with self.tracer.span("tool.parse"):
+            calls = self._parse_tools(new_text)
+        return {"n": self.thought_count, "text": new_text, "calls": calls,
+                "dt": t_elapsed, "tok": tokens, "tps": tokens_per_sec, "reuse": self._prompts.last_reuse,
+                "ctx": (self.context.chars, self.context.tokens), "rejected": rejected}
 
-            # 文脈に追加
-            self.context_text += processed_text + "\n"
+    def _finish_thought(self, job):
+        """ツール実行・表示（直列なら思考スレッド、パイプラインなら worker）"""
+        self._local.n = job["n"]
+        tracing = self.tracer.enabled
+        t0 = time.perf_counter_ns() if tracing else 0
+        try:
+            text = job["text"]
+            job["tool_calls"] = tool_calls = self._run_tools(job)
 
             # 表示
-            print(f"\n\033[2m━━━ #{self.thought_count} [{t_elapsed:.1f}s {tokens_per_sec:.0f}tok/s ctx:{len(self.context_text)}] ━━━\033[0m")
-            print(f"\033[36m{processed_text[:300]}\033[0m")
+            chars, tokens = job["ctx"]
+            print(f"\n\033[2m━━━ #{job['n']} [{job['dt']:.1f}s {job['tps']:.0f}tok/s ctx:{chars}ch/{tokens}tok reuse:{job['reuse']:.0%}] ━━━\033[0m")
+            print(f"\033[36m{text[:300]}\033[0m")
             for tc in tool_calls:
-                print(f"  🔧 {tc['name']} → {tc['result']}")
+                print(f"  🔧 {tc['name']} → {tc['result'][:120]}")
+
+            entry = {"n": job["n"], "content": text}
+            self.thought_log.append(entry)
+            self.events.publish("thought", entry)
+        finally:
+            del self._local.n
+            if tracing:
+                self.tracer.complete("think.finish", t0, time.perf_counter_ns(), {"n": job["n"]})
+
+    def _merge_thought(self, job):
+        """ツールの結果を文脈へ、ツール履歴と新規性の更新・ログ、反復への介入、圧縮の判定（思考スレッド）"""
+        with self.tracer.span("think.merge", n=job["n"]):
+            for tc in job["tool_calls"]:
+                if tc["result"]:
+                    self.context.append("tool_result", tc["result"] + "\n")
+            self._tool_history.extend(job["tool_history"])
+            if "tools_disabled_until" in job:
+                self._tools_disabled_until = job["tools_disabled_until"]
 
             # ログ
-            self.thought_log.append({"n": self.thought_count, "content": processed_text})
-            if len(self.thought_log) > 100:
-                self.thought_log = self.thought_log[-100:]
+            self.novelty.update(job["text"])
+            self._local.n = job["n"]
+            try:
+                self._log("thought", job["text"], {
+                    "dt": round(job["dt"], 2),
+                    "tok": job["tok"],
+                    "tps": round(job["tps"], 1),
+                    "tools": [tc["name"] for tc in job["tool_calls"]],
+                    "reuse": round(job["reuse"], 3),
+                    **self.novelty.stats(),
+                    **({"rejected": job["rejected"]} if job["rejected"] is not None else {}),
+                })
+            finally:
+                del self._local.n
+            job["collapsed"] = self.novelty.collapsed()
 
-            self._log("thought", processed_text, {
-                "dt": round(t_elapsed, 2),
-                "tok": tokens,
-                "tps": round(tokens_per_sec, 1),
-                "tools": [tc["name"] for tc in tool_calls],
-            })
+            # 反復（熱死）への介入
+            if job["collapsed"] and self.thought_count - self._intervened_at >= self.collapse_cooldown:
+                self._intervene()
 
             # 圧縮
-            if len(self.context_text) > self.compress_at_chars:
-                self._compress()
+            self._maybe_compress()
 
-        except Exception as e:
-            print(f"\033[31m[エラー] {e}\033[0m")
-            time.sleep(2)
+    def _current_temperature(self, base=None):
+        base = self.temperature if base is None else base
+        if self.thought_count < self._temperature_boost_until:
+            return min(1.3, base + 0.2)
+        return base
 
-        finally:
-            self.thinking = False
+    def _intervene(self):
+        """新規性が閾値を下回った — 重複区画の除去・温度上げ・早期圧縮"""
+        self._intervened_at = self.thought_count
+        done = []
+        if "dedupe" in self.collapse_actions:
+            removed = self._dedupe_context()
+            if removed: done.append(f"重複{removed}区画除去")
+        if "temperature" in self.collapse_actions:
+            self._temperature_boost_until = self.thought_count + self.collapse_cooldown
+            done.append(f"温度{self._current_temperature():.2f}")
+        if "compress" in self.collapse_actions and not self._compress_thread:
+            self._start_compress() if self.background_compress else self._compress()
+            done.append("早期圧縮")
+        print(f"\033[31m  ♻ 反復検出 score:{self.novelty.score:.2f} → {' / '.join(done) or '介入なし'}\033[0m")
+        self._log("collapse", "", {**self.novelty.stats(), "actions": done})
+
+    def _dedupe_context(self, min_novelty=0.2):
+        """先行する思考とほぼ同じ思考区画を文脈から外す（最新の区画は残す）"""
+        seen, keep, removed = set(), [], 0
+        segs = list(self.context.segments)
+        for i, seg in enumerate(segs):
+            if seg.kind == "thought" and i < len(segs) - 1:
+                grams = ngram_hashes(seg.text, self.novelty.n)
+                if grams and sum(1 for g in grams if g not in seen) / len(grams) < min_novelty:
+                    removed += 1
+                    continue
+                seen |= grams
+            keep.append(seg)
+        if removed:
+            self.context.rebuild(keep)
+        return removed
+
+    def _maybe_compress(self):
+        """圧縮開始を超えていれば要約を始める（裏で、または同期で）"""
+        if not self._needs_compress() or self._compress_thread:
+            return
+        if self.background_compress:
+            self._start_compress()
+        else:
+            self._compress()
 
     def _compress(self):
+        """同期圧縮 — 要約が終わるまで待って差し替える（畳めるものがなければ何もしない）"""
+        if not self._compress_thread:
+            self._start_compress()
+        if self._compress_thread is None:
+            return
+        with self.tracer.span("compress.wait"):
+            self._compress_thread.join()
+        self._apply_compression()
+
+    def _start_compress(self):
+        """次の要約ステップを決め、別スレッドで生成する"""
+        step = self.memory.plan(self.context.segments)
+        if step is None:
+            return
+        step["before"] = self.context.chars
+        step["before_tok"] = self.context.tokens
+        label = f"L{step['level']}統合" if step["kind"] == "merge" else f"{step['chars']}字"
+        print(f"\n\033[33m[圧縮 #{self.compression_count + 1} {step['before']}→ 要約中 {label}]\033[0m")
+
+        def job():
+            try:
+                with self.tracer.span("compress.summarize", level=step["level"], chars=step["before"]):
+                    step["summary"], _ = self._generate(step["prompt"], max_tokens=300, temperature=0.5,
+                                                        via=self._summary_via())
+            except Exception as e:
+                step["error"] = e
+            step["dt"] = time.time() - t0
+            if self._compress_thread is threading.current_thread():  # 途中でリセットされていなければ
+                self._compress_result = step
+
+        t0 = time.time()
+        self._compress_result = None
+        self._compress_thread = threading.Thread(target=job, daemon=True)
+        self._compress_thread.start()
+
+    def _apply_compression(self):
+        """要約が届いていれば記憶の木に加え、文脈を組み直す（思考スレッドからのみ呼ぶ）
+
+        要約したチャンクだけを文脈から外し、要約中に追加された区画はそのまま残す。
+        """
+        step = self._compress_result
+        if step is None:
+            return
+        self._compress_result = None
+        self._compress_thread = None
         self.compression_count += 1
-        before = len(self.context_text)
-        print(f"\n\033[33m[圧縮 #{self.compression_count} {before}→]\033[0m", end="", flush=True)
+        before = step["before"]
+        tracing = self.tracer.enabled
+        t0 = time.perf_counter_ns() if tracing else 0
 
-        prompt = (
-            "以下の思考の流れから、最も重要な洞察と未解決の問いだけを抽出してください。"
-            "結論やまとめは不要。核心の洞察と、次に探求すべき問いだけ残してください。\n\n"
-            f"思考:\n{self.context_text[-2000:]}\n\n"
-            "核心:"
-        )
-        try:
-            summary, _ = self._generate(prompt, max_tokens=300, temperature=0.5)
-        except Exception as e:
-            print(f"\033[31m圧縮エラー: {e}\033[0m")
-            self.context_text = self.context_text[-self.compress_at_chars:]
+        if "error" in step:
+            self.metrics.inc("errors_total", where="compress")
+            print(f"\033[31m圧縮エラー: {step['error']}\033[0m")
+            self.context.truncate_front(self._budget()[0], self.budget_unit)
             return
 
-        self.context_text = f"{self.tool_definitions}\n[記憶の核]: {summary}\n\n"
+        summary = step["summary"]
+        self.memory.commit(step, summary)
+        dropped = {id(seg) for seg in step.get("segments", ())}
+        keep = []
+        for seg in self.context.segments:
+            if id(seg) not in dropped:
+                if seg.kind not in RollingSummarizer.FIXED_KINDS:
+                    keep.append(seg)
+            elif step.get("rest") and seg is step["segments"][0]:
+                # 畳みきれなかった区画の残りはそのまま（同じ種類の区画として）残す
+                counter = self.context.token_counter
+                keep.append(Segment(seg.kind, step["rest"], counter.raw(step["rest"]) if counter else None))
+        # 並び: シード（畳まれたらツール定義だけ）→ 記憶の核 → 残りの思考
+        seed = [seg for seg in keep if seg.kind == "seed"]
+        head = seed or [("tools", f"{self.tool_definitions}\n")]
+        self.context.rebuild(head + [("memory", self.memory.render())] + [seg for seg in keep if seg.kind != "seed"])
 
-        after = len(self.context_text)
-        print(f"\033[33m{after} | {after/before:.1%}\033[0m")
-        self._log("compress", summary, {"before": before, "after": after, "n": self.compression_count})
+        after = self.context.chars
+        if tracing:
+            self.tracer.complete("compress.apply", t0, time.perf_counter_ns(), {"before": before, "after": after})
+        self.metrics.observe("compress_seconds", step["dt"])
+        self.metrics.observe("compress_ratio", after / before if before else 1.0)
+        print(f"\n\033[33m[圧縮 #{self.compression_count} {before}→{after} | {after/before:.1%} {step['dt']:.1f}s]\033[0m")
+        self._log("compress", summary, {"before": before, "after": after, "n": self.compression_count,
+                                        "before_tok": step["before_tok"], "after_tok": self.context.tokens,
+                                        "dt": round(step["dt"], 2), "level": step["level"],
+                                        "merge": step["kind"] == "merge"})
+
+    def _await_compression_if_full(self):
+        """要約中に最大サイズへ達したら、要約の到着を待って差し替える"""
+        if self._compress_thread and self._context_size() > self._budget()[1]:
+            with self.tracer.span("compress.wait"):
+                self._compress_thread.join()
+        self._apply_compression()
 
     # ─── 人間との対話 ───
 
@@ -333,15 +3254,18 @@ class ISBE:
         self._log("human_input", message)
         self.thinking = True
         try:
+            self._await_compression_if_full()
+            self._enforce_max()
             injection = f"\n\n[人間の声]: {message}\n\n[応答]:\n"
-            dialog_context = self.context_text + injection
-            response, tokens = self._generate(dialog_context, max_tokens=512, temperature=0.7)
+            dialog_context = self._prompts.build(self.context_text, injection)
+            response, tokens = self._generate(dialog_context, max_tokens=512, temperature=0.7,
+                                              hints=self._prompts.hints())
             self.total_tokens_generated += tokens
-            self.context_text = dialog_context + response + "\n"
+            self.context.append("human", injection)
+            self.context.append("response", response + "\n")
             self._log("dialog", response, {"human": message})
             self._log_dialog(message, response)
-            if len(self.context_text) > self.compress_at_chars:
-                self._compress()
+            self._maybe_compress()
             return response
         finally:
             self.thinking = False
@@ -349,31 +3273,265 @@ class ISBE:
     # ─── メインループ ───
 
     def _loop(self):
+        self.probe_capabilities()  # 保存済みなら問い合わせない（問い合わせる時も start を待たせない）
         print(f"\n[{self._ts()}] 🔥 思考開始。")
         print(f"{'='*60}\n\033[35m{self.seed_text.strip()}\033[0m\n{'='*60}")
         self._log("session_start", self.seed_text, {"api_url": self.api_url})
 
+        think = self._think_pipelined if self.pipeline else self._think_once
         while self.alive:
-            # 人間の割り込み
-            if self._human_event.is_set():
-                msg = self._human_input
-                self._human_event.clear()
-                self._response_text = self._respond_to_human(msg)
-                self._response_event.set()
+            # 人間の割り込み（届いた順に1件ずつ。先に後処理中の思考を合流させる）
+            if not self._human_queue.empty():
+                self._drain_safely()
+            if self._serve_human():
+                self._checkpoint(force=True)
                 continue
 
-            self._think_once()
-            self._human_event.wait(timeout=0.01)
+            think()
+            self._profile_tick()
+            if not self.pipeline and self.think_interval:  # パイプラインでは間を空けずに次を送る
+                with self.tracer.span("think.idle"):
+                    self._human_event.wait(timeout=self.think_interval)
+
+        self._drain_safely()
+        self._profile_tick(final=True)
 
-    def speak(self, message):
-        self._human_input = message
-        self._response_event.clear()
+        # 止まったら待っている呼び出しを返す
+        while True:
+            try:
+                _, fut, _ = self._human_queue.get_nowait()
+            except queue.Empty:
+                break
+            fut.cancel()
+        self._checkpoint(force=True)
+        if self._journal: self._journal.flush()
+        self._flush_logs()
+        if self._cassette:
+            self._cassette.close()  # 再び start すれば続きから書き足す
+        if self.tracer.enabled:
+            self.export_trace()
+
+    def _serve_human(self):
+        self._human_event.clear()  # 取り出す前に下ろす（後から来た分で必ず立ち直る）
+        try:
+            message, fut, t_put = self._human_queue.get_nowait()
+        except queue.Empty:
+            return False
+        if self.tracer.enabled:
+            self.tracer.complete("human.wait", t_put, time.perf_counter_ns())
+        if fut.set_running_or_notify_cancel():
+            try:
+                with self.tracer.span("human.respond", chars=len(message)):
+                    fut.set_result(self._respond_to_human(message))
+            except Exception as e:
+                self.metrics.inc("errors_total", where="respond")
+                print(f"\033[31m[応答エラー] {e}\033[0m")
+                fut.set_exception(e)
+        return True
+
+    def speak_async(self, message):
+        """人間の声を待ち行列へ — concurrent.futures.Future（応答文）を返す"""
+        fut = Future()
+        self._human_queue.put((message, fut, time.perf_counter_ns()))
+        if self._preemptible:
+            self._cancel.set()
         self._human_event.set()
-        self._response_event.wait(timeout=180)
-        return self._response_text or "(応答なし)"
+        return fut
+
+    async def aspeak(self, message, timeout=180):
+        """asyncio 版 speak"""
+        import asyncio
+        t0 = time.time()
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self.speak_async(message)), timeout) or "(応答なし)"
+        except Exception:  # タイムアウト・生成エラー（呼び出し側の取り消しはそのまま伝える）
+            return "(応答なし)"
+        finally:
+            self.metrics.observe("speak_seconds", time.time() - t0)
+
+    def speak(self, message, timeout=180):
+        t0 = time.time()
+        try:
+            return self.speak_async(message).result(timeout=timeout) or "(応答なし)"
+        except Exception:  # タイムアウト・停止による取り消し・生成エラー
+            return "(応答なし)"
+        finally:
+            self.metrics.observe("speak_seconds", time.time() - t0)
 
     # ─── ライフサイクル ───
 
+    # ─── 計測 ───
+
+    def _make_metrics(self):
+        m = Metrics()
+        m.counter("thoughts_total", "生成した思考の数")
+        m.counter("tokens_generated_total", "生成トークン数")
+        m.histogram("generation_seconds", Metrics.LATENCY, "思考1回の生成時間")
+        m.histogram("tokens_per_second", Metrics.RATE, "思考1回の生成速度")
+        m.histogram("prompt_chars", Metrics.SIZE, "送ったプロンプトの文字数")
+        m.histogram("prompt_tokens", Metrics.SIZE, "送ったプロンプトのトークン数")
+        m.histogram("compress_seconds", Metrics.LATENCY, "要約1回の時間")
+        m.histogram("compress_ratio", Metrics.RATIO, "圧縮後/圧縮前の文字数")
+        m.histogram("speak_seconds", Metrics.LATENCY, "speak() の応答時間")
+        m.counter("tool_calls_total", "ツール呼び出し（tool ラベル）", labeled=True)
+        m.counter("chat_fallback_total", "completions 失敗で chat に切り替えた回数")
+        m.counter("errors_total", "エラー（where ラベル）", labeled=True)
+        m.counter("preempted_total", "人間の声で打ち切った思考")
+        m.counter("candidates_total", "複数候補モードで生成した候補の数")
+        m.gauge("context_chars", lambda: self.context.chars, "文脈の文字数")
+        m.gauge("context_tokens", lambda: self.context.tokens, "文脈のトークン数")
+        m.gauge("novelty_score", lambda: self.novelty.score, "新規性スコア（EWMA）")
+        m.gauge("alive", lambda: int(self.alive), "思考ループが動いているか")
+        return m
+
+    def serve_metrics(self, port, host="127.0.0.1"):
+        server = serve_metrics(self.metrics, port, host)
+        print(f"[{self._ts()}] 📈 メトリクス: http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    # ─── トレース ───
+
+    def set_tracing(self, enabled):
+        self.tracer.enabled = self.trace_opts["enabled"] = bool(enabled)
+        print(f"[{self._ts()}] 🔬 トレース{'開始' if enabled else '停止'}")
+
+    def export_trace(self, path=None):
+        """記録した区間を Chrome trace-event JSON に書き出す。何もなければ None"""
+        if not len(self.tracer):
+            return None
+        path = self.tracer.export(path or self.log_dir / f"trace_{self._log_ts}.json")
+        print(f"[{self._ts()}] 🔬 トレース: {path} ({len(self.tracer)} 区間)")
+        return path
+
+    def request_profile(self, seconds=None):
+        """思考スレッドを seconds 秒 cProfile で測り、is_be_log に .prof を書く（次の思考から）"""
+        seconds = seconds or self.trace_opts["profile_seconds"]
+        path = self.log_dir / f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof"
+        self.tracer.request_profile(seconds, path)
+        print(f"[{self._ts()}] ⏱ プロファイル予約: {seconds}秒 → {path.name}")
+        return path
+
+    def _profile_tick(self, final=False):
+        path = self.tracer.profile_tick(final)
+        if path:
+            print(f"[{self._ts()}] ⏱ プロファイル: {path}（python -m pstats {path} で表示）")
+            self.events.publish("profile", str(path))
+
+    # ─── チェックポイント ───
+
+    def _checkpoint_state(self):
+        """追記のたびに書く小さな状態値"""
+        return {"thought_count": self.thought_count, "compression_count": self.compression_count,
+                "total_tokens_generated": self.total_tokens_generated,
+                "tools_disabled_until": self._tools_disabled_until, "tool_history": list(self._tool_history),
+                "temperature_boost_until": self._temperature_boost_until, "intervened_at": self._intervened_at,
+                "memory": [list(items) for items in self.memory.levels], "token_scale": self.tokenizer.scale,
+                "token_calibrated": self.tokenizer.calibrated}
+
+    def _checkpoint(self, force=False):
+        """文脈が変わっていれば書く — 追記だけなら差分、組み直されていれば全体
+
+        ここ（思考スレッド）では状態を写し取るだけで、直列化と書き込みはジャーナルのスレッドが行う。
+        パイプラインでは worker が thought_log に書くので、worker が空いている時に呼ぶ。
+        """
+        every = self.checkpoint_opts.get("every")
+        ctx, mark = self.context, self._ckpt_mark
+        last_n = self.thought_log[-1]["n"] if self.thought_log else 0
+        if not every or (mark and mark[3] == ctx.version and mark[4] == last_n):
+            return
+        if not force and mark and self.thought_count - mark[2] < every:
+            return
+        path = self.log_dir / f"ckpt_{self._log_ts}.jsonl"
+        tracing = self.tracer.enabled
+        t0 = time.perf_counter_ns() if tracing else 0
+        try:
+            if self._journal is None or self._journal.path != path:
+                if self._journal: self._journal.close()
+                self._journal = CheckpointJournal(path, self.checkpoint_opts.get("compact_ratio", 2.0),
+                                                  self.checkpoint_opts.get("fsync", False), tracer=self.tracer)
+                mark = None
+            state = self._checkpoint_state()
+            thoughts = list(self.thought_log)
+            delta = None
+            if mark and mark[0] == ctx.epoch:
+                delta = dict(state, append=[[seg.kind, seg.text, seg.raw] for seg in ctx.since(mark[1])],
+                             thoughts=[t for t in thoughts if t["n"] > mark[4]])
+            base = dict(state, seed_text=self.seed_text, tool_definitions=self.tool_definitions,
+                        birth=self.birth.isoformat(), log_ts=self._log_ts,
+                        log_file=str(self.log_file), dialog_log_file=str(self.dialog_log_file),
+                        segments=[[seg.kind, seg.text, seg.raw] for seg in ctx],
+                        thought_log=thoughts)
+            self._journal.submit(delta, base)
+            self._ckpt_mark = (ctx.epoch, ctx.appends, self.thought_count, ctx.version,
+                               thoughts[-1]["n"] if thoughts else 0)
+        except Exception as e:
+            print(f"[{self._ts()}] ⚠ チェックポイント失敗: {e}")
+        if tracing:
+            self.tracer.complete("checkpoint", t0, time.perf_counter_ns(), {"full": mark is None})
+
+    def restore(self, path):
+        """チェックポイントから状態を戻す（同じログファイルに続けて書く）。start の前に呼ぶ"""
+        t0 = time.time()
+        path = Path(path)
+        st = CheckpointJournal.load(path)
+        self.seed_text = st["seed_text"]
+        self.tool_definitions = st["tool_definitions"]
+        self.context.rebuild(Segment(kind, text, raw) for kind, text, raw in st["segments"])
+        self.thought_count = st["thought_count"]
+        self.compression_count = st["compression_count"]
+        self.total_tokens_generated = st["total_tokens_generated"]
+        self._tools_disabled_until = st["tools_disabled_until"]
+        self._tool_history.clear(); self._tool_history.extend(st["tool_history"])
+        self.thought_log.clear(); self.thought_log.extend(st["thought_log"])
+        self._temperature_boost_until = st["temperature_boost_until"]
+        self._intervened_at = st["intervened_at"]
+        self.memory.levels = st["memory"]
+        self.tokenizer.scale, self.tokenizer.calibrated = st["token_scale"], st["token_calibrated"]
+        self.birth = datetime.fromisoformat(st["birth"])
+
+        for w in (self._log_writer, self._dialog_writer):
+            if w: w.close()
+        self._log_ts = st["log_ts"]
+        self.log_file, self.dialog_log_file = Path(st["log_file"]), Path(st["dialog_log_file"])
+        self._log_writer = LogWriter(self.log_file, tracer=self.tracer, **self.log_opts)
+        self._dialog_writer = LogWriter(self.dialog_log_file, tracer=self.tracer, **self.log_opts)
+
+        # 書きかけの末尾を捨てるため、読んだ状態で全体を書き直す
+        if self._journal: self._journal.close()
+        self._journal = CheckpointJournal(path, self.checkpoint_opts.get("compact_ratio", 2.0),
+                                          self.checkpoint_opts.get("fsync", False), tracer=self.tracer)
+        self._ckpt_mark = None
+        self._checkpoint(force=True)
+        self._journal.flush()
+        dt = time.time() - t0
+        self._log("resume", str(path), {"n": self.thought_count, "dt": round(dt, 3)})
+        self.events.publish("reset")
+        print(f"[{self._ts()}] ♻ 再開: {path.name} #{self.thought_count} "
+              f"ctx:{self.context.chars}ch ({dt * 1000:.0f}ms)")
+
+    def apply_seed(self, text):
+        """シードを差し替えて新しいセッションにする（停止中のみ）。できなければ False"""
+        if self.alive:
+            return False
+        self.seed_text = text
+        self.context.reset(text)
+        self.tool_definitions = text.split("---")[0] if "---" in text else TOOL_DEFINITIONS
+        self.thought_count = 0
+        self.compression_count = 0
+        self.total_tokens_generated = 0
+        self._tool_history.clear()
+        self._pending_messages.clear()
+        self.thought_log.clear()
+        self.memory.reset()
+        self.novelty.reset()
+        self._temperature_boost_until = 0
+        self._compress_thread = None
+        self._compress_result = None
+        self._pending_job = None
+        self._new_log_session()
+        self.events.publish("reset")
+        return True
+
     def _safe_model_tag(self):
         """モデル名からファイル名に使える短いタグを生成"""
         if not self.model_name:
@@ -383,17 +3541,25 @@ class ISBE:
             tag = tag[-50:]
         return tag
 
+    def _new_log_session(self, ts=None):
+        """新しいセッションのログファイルを用意（書き込みは LogWriter が裏で行う）"""
+        for w in (self._log_writer, self._dialog_writer):
+            if w: w.close()
+        self._log_ts = (ts or datetime.now()).strftime('%Y%m%d_%H%M%S')
+        self.log_file = self.log_dir / f"full_{self._log_ts}.jsonl"
+        self.dialog_log_file = self.log_dir / f"dialog_{self._log_ts}.jsonl"
+        self._log_writer = LogWriter(self.log_file, tracer=self.tracer, **self.log_opts)
+        self._dialog_writer = LogWriter(self.dialog_log_file, tracer=self.tracer, **self.log_opts)
+
     def _rename_logs_with_model(self):
         """モデル名確定後にログファイルをリネーム"""
         tag = self._safe_model_tag()
         new_log = self.log_dir / f"full_{self._log_ts}_{tag}.jsonl"
         new_dialog = self.log_dir / f"dialog_{self._log_ts}_{tag}.jsonl"
         try:
-            if self.log_file.exists():
-                self.log_file.rename(new_log)
+            self._log_writer.rename(new_log)
             self.log_file = new_log
-            if self.dialog_log_file.exists():
-                self.dialog_log_file.rename(new_dialog)
+            self._dialog_writer.rename(new_dialog)
             self.dialog_log_file = new_dialog
             print(f"[{self._ts()}] 📝 ログ: {new_log.name}")
         except Exception as e:
@@ -409,38 +3575,578 @@ class ISBE:
         self.alive = True
         self._thread = threading.Thread(target=self._loop, daemon=True)
         self._thread.start()
+        self.events.publish("status")
         return True
 
     def stop(self):
         self.alive = False
         self._human_event.set()
+        self.events.publish("status")
+        self._flush_logs()
         u = datetime.now() - self.birth
         print(f"\n[{self._ts()}] 消灯。稼働:{str(u).split('.')[0]} 思考:{self.thought_count}")
 
+    def close(self, timeout=10):
+        """使い終えた心の後始末 — ループを止め、ログ・索引・ジャーナルのスレッドと HTTP 接続を閉じる"""
+        if self.alive:
+            self.stop()
+        thread = getattr(self, "_thread", None)
+        if thread and thread.is_alive():
+            thread.join(timeout)
+        if self._post_pool:
+            self._post_pool.shutdown(wait=True)
+            self._post_pool = None
+        if self._journal:
+            self._journal.close(timeout)
+        for w in (self._log_writer, self._dialog_writer):
+            w.close(timeout)
+        self.memory_store.close(timeout)
+        if self.search_backend is not None and hasattr(self.search_backend, "close"):
+            self.search_backend.close()
+        self.transport.close()
+        if self._summary_transport and self._summary_transport is not self.transport:
+            self._summary_transport.close()
+
     def status(self):
         u = datetime.now() - self.birth
-        a = sum(self._thought_durations) / len(self._thought_durations) if self._thought_durations else 0
+        a = self.metrics.get("generation_seconds")
+        a = a.mean() if a else 0
         return {"uptime": str(u).split('.')[0], "thoughts": self.thought_count,
-                "compressions": self.compression_count, "context_chars": len(self.context_text),
+                "compressions": self.compression_count, "context_chars": self.context.chars,
+                "context_tokens": self.context.tokens,
                 "total_tokens": self.total_tokens_generated, "avg_thought_sec": round(a, 1),
-                "thinking": self.thinking, "model": self.model_name or "不明"}
+                "thinking": self.thinking, "model": self.model_name or "不明",
+                "prefix_reuse": round(self._prompts.last_reuse, 3),
+                "novelty": self.novelty.stats(),
+                "connections": self.transport.connection_stats()}
+
+    def post_message(self, content):
+        """対話パネルへ（履歴は message_history 件まで）"""
+        m = {"content": content, "time": datetime.now().isoformat()}
+        self._pending_messages.append(m)
+        self.events.publish("message", m)
 
     def _ts(self):
         return datetime.now().strftime("%H:%M:%S")
 
+    def _flush_logs(self):
+        """キューに残ったログを書き切って fsync"""
+        with self.tracer.span("log.flush"):
+            for w in (self._log_writer, self._dialog_writer):
+                w.flush(fsync=True)
+
     def _log(self, kind, content, meta=None):
         # コンパクトフォーマット: n(順番)とk(種類)とc(内容)のみ。時刻はファイル名に開始時刻あり
-        e = {"n": self.thought_count, "k": kind, "c": content}
+        tracing = self.tracer.enabled  # 無効時は時刻も取らない（呼ばれる回数が多い）
+        t0 = time.perf_counter_ns() if tracing else 0
+        e = {"n": self._n(), "k": kind, "c": content}
         if meta:
             e.update(meta)  # metaをフラット化（ネストしない）
-        with open(self.log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+        self._log_writer.write(e)
+        self.memory_store.add(self._log_ts, e)
+        if tracing:
+            self.tracer.complete("log.queue", t0, time.perf_counter_ns(), {"kind": kind})
+
+    def _n(self):
+        """いま処理中の思考番号（パイプラインの worker では受け持ちの思考）"""
+        return getattr(self._local, "n", self.thought_count)
 
     def _log_dialog(self, human_msg, ai_response):
         # コンパクト: n(順番) + h(人間) + a(AI応答)のみ。時刻・ctx不要
         e = {"n": self.thought_count, "h": human_msg, "a": ai_response}
-        with open(self.dialog_log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+        self._dialog_writer.write(e)
+
+
+# ═══════════════════════════════════════════════════════════════════
+# ログ解析
+# ═══════════════════════════════════════════════════════════════════
+
+LOG_SEGMENT_RE = re.compile(r'^(full_.+?)(?:\.(\d{4}))?\.jsonl(\.gz|\.zst)?$')
+
+
+def _open_log(path):
+    """JSONL（.gz / .zst 含む）をバイナリで開く"""
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    if path.suffix == ".zst":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def log_sessions(log_dir):
+    """セッション名 → 時系列順のファイル（番号付きセグメント → 現行ファイル）"""
+    sessions = {}
+    for p in Path(log_dir).iterdir():
+        m = LOG_SEGMENT_RE.match(p.name)
+        if m:
+            seg = int(m.group(2)) if m.group(2) else 10 ** 6
+            sessions.setdefault(m.group(1), []).append((seg, p))
+    return {name: [p for _, p in sorted(files)] for name, files in sorted(sessions.items())}
+
+
+def _thought_hash(text):
+    norm = re.sub(r'[\s\d]+', '', text or "")
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=4).hexdigest()
+
+
+def index_log(path):
+    """サイドカー索引（<file>.idx）を作る/更新する — 追記された分だけ読む
+
+    索引: 種類ごとの [思考番号, バイト位置]、tps/dt の列、ツール回数、圧縮の before/after、思考ハッシュ列。
+    """
+    idx_path = path.with_name(path.name + ".idx")
+    st = path.stat()
+    idx = None
+    if idx_path.exists():
+        try:
+            with open(idx_path, "r", encoding="utf-8") as f:
+                idx = json.load(f)
+        except Exception:
+            idx = None
+    if idx and idx.get("v") == 1:
+        if idx["mtime"] == st.st_mtime and idx["size"] == st.st_size:
+            return idx
+        if path.suffix != ".jsonl" or st.st_size < idx["end"]:
+            idx = None  # 圧縮済みファイルが変わった/切り詰められた — 作り直す
+    if not idx or idx.get("v") != 1:
+        idx = {"v": 1, "end": 0, "events": 0, "kinds": {}, "tps": [], "dt": [], "tok": 0,
+               "tools": {}, "compress": [], "hashes": []}
+
+    with _open_log(path) as f:
+        if idx["end"]:
+            f.seek(idx["end"])
+        offset = idx["end"]
+        for line in f:
+            start, offset = offset, offset + len(line)
+            if not line.endswith(b"\n"):
+                offset = start  # 書きかけの行は次回
+                break
+            try:
+                e = json.loads(line)
+            except ValueError:
+                continue
+            idx["events"] += 1
+            kind = e.get("k", "?")
+            idx["kinds"].setdefault(kind, []).append([e.get("n", 0), start])
+            if kind == "thought":
+                if "tps" in e: idx["tps"].append(e["tps"])
+                if "dt" in e: idx["dt"].append(e["dt"])
+                idx["tok"] += e.get("tok", 0)
+                for t in e.get("tools", []):
+                    idx["tools"][t] = idx["tools"].get(t, 0) + 1
+                idx["hashes"].append(_thought_hash(e.get("c")))
+            elif kind == "compress" and e.get("before"):
+                idx["compress"].append([e["before"], e.get("after", 0)])
+        idx["end"] = offset
+    idx["size"], idx["mtime"] = st.st_size, st.st_mtime
+    tmp = idx_path.with_name(idx_path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(idx, f, separators=(",", ":"))
+    os.replace(tmp, idx_path)
+    return idx
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return round(values[lo] + (values[hi] - values[lo]) * (k - lo), 2)
+
+
+class RepeatWatch:
+    """崩壊判定 — 直近 window 思考と重複する思考が run 回続いたら崩壊とみなす"""
+
+    def __init__(self, window=50, run=5):
+        self.recent = deque(maxlen=window)
+        self.run = run
+        self.streak = 0
+        self.count = 0
+        self.collapse_at = None  # 崩壊が始まった思考の位置（1 始まり）
+
+    def update(self, h):
+        self.count += 1
+        self.streak = self.streak + 1 if h in self.recent else 0
+        self.recent.append(h)
+        if self.streak >= self.run and self.collapse_at is None:
+            self.collapse_at = self.count - self.run + 1
+        return self.collapse_at is not None
+
+
+def thoughts_until_collapse(hashes, window=50, run=5):
+    """崩壊までの思考数（崩壊なしは None）"""
+    watch = RepeatWatch(window, run)
+    for h in hashes:
+        if watch.update(h):
+            break
+    return watch.collapse_at
+
+
+def analyze_session(files):
+    """セッションの集計 — ファイルごとの索引を連結するだけ（ログ本体は再走査しない）"""
+    tps, dt, hashes, compress, tools, tok, events, thoughts = [], [], [], [], {}, 0, 0, 0
+    for p in files:
+        idx = index_log(p)
+        tps += idx["tps"]; dt += idx["dt"]; hashes += idx["hashes"]; compress += idx["compress"]
+        tok += idx["tok"]; events += idx["events"]
+        thoughts += len(idx["kinds"].get("thought", []))
+        for t, c in idx["tools"].items():
+            tools[t] = tools.get(t, 0) + c
+    ratios = [a / b for b, a in compress if b]
+    return {"thoughts": thoughts, "events": events, "tokens": tok,
+            "tps_p50": _percentile(tps, 50), "tps_p90": _percentile(tps, 90), "tps_p99": _percentile(tps, 99),
+            "dt_p50": _percentile(dt, 50), "dt_p99": _percentile(dt, 99),
+            "compressions": len(compress),
+            "compress_ratio": round(sum(ratios) / len(ratios), 3) if ratios else None,
+            "tools": tools, "tools_per_thought": round(sum(tools.values()) / thoughts, 3) if thoughts else 0,
+            "collapse_at": thoughts_until_collapse(hashes), "_tps": tps}
+
+
+def find_thought(files, n):
+    """思考 #n をバイト位置へのシークで取り出す"""
+    for p in files:
+        for tn, off in index_log(p)["kinds"].get("thought", []):
+            if tn == n:
+                with _open_log(p) as f:
+                    f.seek(off)
+                    return json.loads(f.readline())
+    return None
+
+
+def run_analyze(args):
+    sessions = log_sessions(args.log_dir)
+    if args.sessions:
+        sessions = {k: v for k, v in sessions.items() if any(s in k for s in args.sessions)}
+    if args.show is not None:
+        for name, files in sessions.items():
+            e = find_thought(files, args.show)
+            if e:
+                print(f"# {name}")
+                print(json.dumps(e, ensure_ascii=False, indent=2))
+        return
+
+    rows, all_tps = {}, []
+    for name, files in sessions.items():
+        r = analyze_session(files)
+        all_tps += r.pop("_tps")
+        rows[name] = r
+    total = {"sessions": len(rows), "thoughts": sum(r["thoughts"] for r in rows.values()),
+             "tokens": sum(r["tokens"] for r in rows.values()),
+             "tps_p50": _percentile(all_tps, 50), "tps_p90": _percentile(all_tps, 90),
+             "tps_p99": _percentile(all_tps, 99)}
+    collapses = [r["collapse_at"] for r in rows.values() if r["collapse_at"]]
+    total["collapse_median"] = _percentile(collapses, 50)
+
+    if args.json:
+        print(json.dumps({"sessions": rows, "total": total}, ensure_ascii=False, indent=2))
+        return
+    fmt = lambda v: "—" if v is None else str(v)
+    print(f"{'session':<48} {'思考':>7} {'tok/s p50':>9} {'p99':>6} {'圧縮':>4} {'比':>6} {'tool/思考':>9} {'崩壊':>6}")
+    for name, r in rows.items():
+        print(f"{name[-48:]:<48} {r['thoughts']:>7} {fmt(r['tps_p50']):>9} {fmt(r['tps_p99']):>6} "
+              f"{r['compressions']:>4} {fmt(r['compress_ratio']):>6} {r['tools_per_thought']:>9} {fmt(r['collapse_at']):>6}")
+    print(f"\n{total['sessions']} セッション / {total['thoughts']:,} 思考 / {total['tokens']:,} tok"
+          f" — tok/s p50:{fmt(total['tps_p50'])} p90:{fmt(total['tps_p90'])} p99:{fmt(total['tps_p99'])}"
+          f" 崩壊中央値:{fmt(total['collapse_median'])}")
+
+
+# ═══════════════════════════════════════════════════════════════════
+# シード評価（ヘッドレス一括実行）
+# ═══════════════════════════════════════════════════════════════════
+
+def load_seed_files(seeds_dir):
+    """./seeds/*.json 形式（{"name", "seed"}）を読む"""
+    seeds = []
+    for p in sorted(Path(seeds_dir).glob("*.json")):
+        try:
+            with open(p, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("seed"):
+                seeds.append((data.get("name") or p.stem, data["seed"]))
+        except Exception as e:
+            print(f"[シード読込エラー] {p.name}: {e}", file=sys.stderr)
+    return seeds
+
+
+def eval_seed(name, seed_text, run, url, out_dir, max_turns, window, repeat_run, time_limit):
+    """1 つの心を崩壊か上限まで同期で回す"""
+    safe = re.sub(r'[^\w\-]+', '_', name)[:60]
+    mind = ISBE(api_url=url, seed_text=seed_text, log_dir=Path(out_dir) / f"{safe}_{run}")
+    mind.tool_definitions = seed_text.split("---")[0] if "---" in seed_text else TOOL_DEFINITIONS
+    row = {"seed": name, "run": run, "backend": url, "turns": 0, "collapsed": False,
+           "collapse_at": None, "tokens": 0, "compressions": 0, "wall_sec": 0.0, "error": ""}
+    t0 = time.time()
+    try:
+        if not mind.check_connection():
+            row["error"] = "connection"
+            return row
+        if mind.search_backend is not None and hasattr(mind.search_backend, "wait"):
+            mind.search_backend.wait()  # 索引の出来上がりで結果が変わらないように
+        mind._rename_logs_with_model()
+        mind._log("session_start", seed_text, {"api_url": url, "eval": True})
+        watch = RepeatWatch(window, repeat_run)
+        attempts = 0
+        while mind.thought_count < max_turns and attempts < max_turns * 2 and time.time() - t0 < time_limit:
+            attempts += 1
+            before = mind.thought_count
+            mind._think_once()
+            if mind.thought_count > before and watch.update(_thought_hash(mind.thought_log[-1]["content"])):
+                break
+        mind._flush_logs()
+        row.update(turns=mind.thought_count, collapsed=watch.collapse_at is not None, collapse_at=watch.collapse_at,
+                   tokens=mind.total_tokens_generated, compressions=mind.compression_count,
+                   wall_sec=round(time.time() - t0, 1))
+        return row
+    finally:
+        mind.close()
+
+
+def run_eval(args):
+    """シード群 × runs を複数バックエンドで並列に評価し、1 つの表にまとめる"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    seeds = load_seed_files(args.seeds_dir)
+    if not seeds:
+        print(f"シードがありません: {args.seeds_dir}", file=sys.stderr)
+        return
+    urls = args.url or ["http://localhost:1234"]
+    # バックエンドごとの同時実行枠（空いた枠を取ったワーカーがそのバックエンドで回す）
+    slots = queue.Queue()
+    for url in urls:
+        for _ in range(args.concurrency):
+            slots.put(url)
+    out_dir = Path(args.out_dir) / datetime.now().strftime('%Y%m%d_%H%M%S')
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    def task(name, text, run):
+        url = slots.get()
+        try:
+            return eval_seed(name, text, run, url, out_dir, args.max_turns, args.window,
+                             args.repeat_run, args.time_limit)
+        finally:
+            slots.put(url)
+
+    jobs = [(name, text, run) for name, text in seeds for run in range(args.runs)]
+    print(f"[評価] {len(seeds)} シード × {args.runs} 回 / {len(urls)} バックエンド × {args.concurrency} 並列",
+          file=sys.stderr)
+    rows = []
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w", encoding="utf-8")  # 心ごとの表示は捨てる（ログには残る）
+    try:
+        with ThreadPoolExecutor(max_workers=len(urls) * args.concurrency) as pool:
+            futures = [pool.submit(task, *job) for job in jobs]
+            for fut in as_completed(futures):
+                row = fut.result()
+                rows.append(row)
+                print(f"  {len(rows)}/{len(jobs)} {row['seed']}#{row['run']} → {row['turns']} 思考"
+                      f"{' 崩壊' if row['collapsed'] else ''} {row['error']}", file=sys.stderr)
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    rows.sort(key=lambda r: (r["seed"], r["run"]))
+    cols = ["seed", "run", "backend", "turns", "collapsed", "collapse_at", "tokens", "compressions", "wall_sec", "error"]
+    with open(out_dir / "summary.tsv", "w", encoding="utf-8") as f:
+        f.write("\t".join(cols) + "\n")
+        for r in rows:
+            f.write("\t".join("" if r[c] is None else str(r[c]) for c in cols) + "\n")
+    with open(out_dir / "summary.json", "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+
+    print(f"{'seed':<32} {'run':>3} {'思考':>6} {'崩壊':>6} {'tok':>8} {'秒':>7}")
+    for r in rows:
+        print(f"{r['seed'][:32]:<32} {r['run']:>3} {r['turns']:>6} {r['collapse_at'] or '—':>6} "
+              f"{r['tokens']:>8} {r['wall_sec']:>7}")
+    print(f"\n📝 {out_dir / 'summary.tsv'}")
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 再生（カセットでの回帰テスト・プロファイル）
+# ═══════════════════════════════════════════════════════════════════
+
+def run_replay(args):
+    """録ったセッションを GPU なしで _loop ごと再現し、速度と食い違いを報告する"""
+    cassette = Cassette.load(args.cassette)
+    # 実行ごとに空のログ（remember が前の再生の記憶を拾わないように）
+    log_dir = Path(args.log_dir) / datetime.now().strftime('%Y%m%d_%H%M%S')
+    log_dir.mkdir(parents=True, exist_ok=True)
+    replay = ReplayTransport(cassette, args.latency)
+    mind = ISBE(log_dir=log_dir, transport=replay)  # 文脈を作る前から再生（実サーバーへは一度も送らない）
+    mind.replay_from(replay)
+    mind.CONFIG_FILE = mind.log_dir / "autoloop_config.json"  # 設定は読むだけ（能力の再確認などで上書きしない）
+    seed = Path(args.seed).read_text(encoding="utf-8") if args.seed else cassette.header.get("seed")
+    if seed and seed != mind.seed_text:
+        mind.apply_seed(seed)
+    mind.background_compress = args.async_compress  # 既定は同期（圧縮の差し込み位置をタイミングに依らせない）
+    mind.think_interval = args.latency and mind.think_interval  # 待たない再生では思考の間も空けない
+    if args.trace:
+        mind.tracer.enabled = True
+    if mind.search_backend is not None and hasattr(mind.search_backend, "wait"):
+        mind.search_backend.wait()  # 索引の出来上がりで検索結果（＝再生の食い違い）が変わらないように
+    target = args.thoughts or float("inf")
+
+    real_stdout = sys.stdout
+    if args.quiet:
+        sys.stdout = open(os.devnull, "w", encoding="utf-8")
+    t0 = time.perf_counter()
+    try:
+        if mind.start():
+            while mind.alive and mind.thought_count < target and (args.thoughts or not mind.transport.exhausted()):
+                time.sleep(0.002)
+            mind.stop()
+            mind._thread.join(timeout=30)
+    finally:
+        if args.quiet:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+    wall = time.perf_counter() - t0
+
+    report = dict(mind.transport.report(), thoughts=mind.thought_count, compressions=mind.compression_count,
+                  wall_sec=round(wall, 3), thoughts_per_sec=round(mind.thought_count / wall, 1) if wall else None)
+    out = mind.log_dir / f"divergence_{mind._log_ts}.json"
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    mind.close()
+
+    print(f"\n📼 {cassette.path.name}: 思考 {mind.thought_count} / {wall:.2f}s ({report['thoughts_per_sec']} 思考/秒)")
+    print(f"   要求 {report['requests']}  一致 {report['hits']}  食い違い {report['misses']}  "
+          f"録音後 {report['beyond']}  使い回し {report['reused']}  応答なし {report['unserved']}")
+    for path, c in sorted(report["by_path"].items()):
+        print(f"   {path:<24} 一致 {c['hits']:>6}  食い違い {c['misses']:>6}")
+    d = report["first_divergence"]
+    if d:
+        where = f"思考 #{d['at']} " if "at" in d else ""
+        print(f"\033[33m   最初の食い違い: {where}要求 {d['request']} {d['path']} "
+              f"{d['chars']}字（録音 {d.get('recorded_chars', '?')}字）"
+              f"{'、' + str(d['offset']) + '字目付近から' if 'offset' in d else ''}"
+              f"{'、本文は同じで候補数 n が違う（' + str(d['n']) + '、録音 ' + str(d['recorded_n'] or '?') + '）' if 'n' in d else ''}"
+              f"\033[0m")
+        if d.get("excerpt"):
+            print(f"   > {d['excerpt'][:120]!r}")
+    else:
+        print("\033[32m   食い違いなし\033[0m")
+    print(f"📝 {out}")
+    if args.strict and report["misses"]:
+        sys.exit(1)
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 制御 API（--daemon、Gradio なし）
+# ═══════════════════════════════════════════════════════════════════
+
+def serve_control(mind, port, host="127.0.0.1"):
+    """UI の操作と同じことをする JSON API（標準ライブラリの http.server のみ）
+
+        GET  /status               状態（ISBE.status）
+        GET  /events?cursor=N&wait=S  cursor 以降の思考・対話（wait 秒まで変化を待つ）
+        GET  /metrics              Prometheus 形式
+        POST /start  /stop
+        POST /speak  {"message": "...", "timeout": 180}
+        POST /seed   {"seed": "..."}
+        POST /trace  {"enabled": true}     記録の切り替え（enabled 省略時は書き出しのみ）→ {"path": ...}
+        POST /profile {"seconds": 30}      思考スレッドの cProfile を予約 → {"path": ...}
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qs
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, obj, ctype="application/json; charset=utf-8"):
+            body = obj.encode("utf-8") if isinstance(obj, str) else json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            """JSON の本文（dict でなければ空）。Content-Length が不正なら None"""
+            try:
+                n = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                return None
+            if n < 0:
+                return None
+            if not n:
+                return {}
+            try:
+                data = json.loads(self.rfile.read(n))
+                return data if isinstance(data, dict) else {}
+            except ValueError:
+                return {}
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            q = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            if url.path == "/status":
+                self._send(200, dict(mind.status(), alive=mind.alive))
+            elif url.path == "/events":
+                try:
+                    cursor, wait = int(q.get("cursor", 0)), min(float(q.get("wait", 0)), 60)
+                except ValueError:
+                    return self._send(400, {"error": "cursor/wait は数値"})
+                if wait > 0:
+                    mind.events.wait(cursor, timeout=wait)
+                cursor, items = mind.events.since(cursor)
+                self._send(200, {"cursor": cursor, "events": [{"seq": seq, "topic": topic, "data": data}
+                                                                for seq, topic, data in items]})
+            elif url.path == "/metrics":
+                self._send(200, mind.metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            path = urlsplit(self.path).path
+            body = self._body()
+            if body is None:
+                return self._send(400, {"error": "Content-Length が不正です"})
+            if path == "/start":
+                self._send(200, {"ok": mind.start()})
+            elif path == "/stop":
+                mind.stop()
+                self._send(200, {"ok": True})
+            elif path == "/speak":
+                message = str(body.get("message", "")).strip()
+                if not message:
+                    return self._send(400, {"error": "message が空です"})
+                try:
+                    timeout = float(body.get("timeout", 180))
+                except (TypeError, ValueError):
+                    timeout = math.nan
+                if not (math.isfinite(timeout) and timeout > 0):
+                    return self._send(400, {"error": "timeout は正の数値"})
+                mind.post_message(f"🫵 {message}")
+                response = mind.speak(message, timeout=timeout)
+                mind.post_message(f"💬 {response}")
+                self._send(200, {"response": response})
+            elif path == "/seed":
+                seed = body.get("seed")
+                if not isinstance(seed, str) or not seed.strip():
+                    return self._send(400, {"error": "seed が空です"})
+                ok = mind.apply_seed(seed)
+                self._send(200 if ok else 409, {"ok": ok} if ok else {"ok": False, "error": "停止してから変更してください"})
+            elif path == "/trace":
+                if "enabled" in body:
+                    mind.set_tracing(body["enabled"])
+                out = mind.export_trace()
+                self._send(200, {"enabled": mind.tracer.enabled, "spans": len(mind.tracer),
+                                 "path": str(out) if out else None})
+            elif path == "/profile":
+                try:
+                    seconds = float(body.get("seconds") or mind.trace_opts["profile_seconds"])
+                except (TypeError, ValueError):
+                    return self._send(400, {"error": "seconds は数値"})
+                self._send(200, {"path": str(mind.request_profile(seconds)), "alive": mind.alive})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
 
 
 # ═══════════════════════════════════════════════════════════════════
@@ -455,18 +4161,29 @@ def create_gradio_ui(mind):
             return "⚫ 停止中"
         return f"🟢 思考中 #{mind.thought_count}"
 
-    def get_messages():
-        if not mind._pending_messages:
+    def budget_label():
+        c, m = mind._budget()
+        return f"{c:,} / {m:,} ({mind.budget_unit})"
+
+    def render_messages(msgs):
+        if not msgs:
             return "..."
-        msgs = [f"💭 {m['content']}" for m in mind._pending_messages[-10:]]
-        return "\n\n".join(reversed(msgs))
+        return "\n\n".join(f"💭 {m['content']}" for m in reversed(msgs))
 
-    def get_thoughts():
-        if not mind.thought_log:
+    def render_thoughts(entries):
+        logs = [f"#{t['n']} {t['content'][:100]}" for t in reversed(entries)]
+        if mind.partial_thought:
+            logs.insert(0, f"#{mind.thought_count + 1}… {mind.partial_thought[-100:]}")
+        if not logs:
             return "..."
-        logs = [f"#{t['n']} {t['content'][:100]}" for t in reversed(mind.thought_log[-20:])]
         return "\n".join(logs)
 
+    def get_messages():
+        return render_messages(list(mind._pending_messages)[-10:])
+
+    def get_thoughts():
+        return render_thoughts(list(mind.thought_log)[-20:])
+
     def start():
         if not mind.alive:
             mind.start()
@@ -479,11 +4196,42 @@ def create_gradio_ui(mind):
     def refresh():
         return get_status(), get_messages(), get_thoughts()
 
+    def feed():
+        """接続ごとの差分配信。変化があったときだけ、変わった欄だけを送る"""
+        cursor = mind.events.seq
+        msgs = deque(list(mind._pending_messages)[-10:], maxlen=10)
+        entries = deque(list(mind.thought_log)[-20:], maxlen=20)
+        yield get_status(), render_messages(msgs), render_thoughts(entries)
+        pokes, last_push = mind.events.pokes, time.monotonic()
+        while True:
+            if not mind.events.wait(cursor, pokes, timeout=30):
+                yield gr.update(), gr.update(), gr.update()  # 切断検出用（30秒に一度）
+                continue
+            pokes = mind.events.pokes
+            cursor, items = mind.events.since(cursor)
+            topics = {topic for _, topic, _ in items}
+            for _, topic, data in items:  # 届いた順に（reset より後の分は残す）
+                if topic == "message": msgs.append(data)
+                elif topic == "thought": entries.append(data)
+                elif topic == "reset": msgs.clear(); entries.clear()
+            streaming = not items  # poke のみ＝生成途中の表示
+            with mind.tracer.span("ui.render", events=len(items)):
+                out = (get_status() if topics & {"status", "thought", "reset"} else gr.update(),
+                       render_messages(msgs) if topics & {"message", "reset"} else gr.update(),
+                       render_thoughts(entries) if streaming or topics & {"thought", "reset"} else gr.update())
+            yield out
+            # ストリーム中のトークンごとの更新は 4回/秒に間引く
+            wait = 0.25 - (time.monotonic() - last_push)
+            if wait > 0:
+                time.sleep(wait)
+            last_push = time.monotonic()
+
     def reply(text):
         if text.strip():
-            mind._pending_messages.append({"content": f"🫵 {text}", "time": datetime.now().isoformat()})
-            response = mind.speak(text)
-            mind._pending_messages.append({"content": f"💬 {response}", "time": datetime.now().isoformat()})
+            with mind.tracer.span("ui.reply"):
+                mind.post_message(f"🫵 {text}")
+                response = mind.speak(text)
+                mind.post_message(f"💬 {response}")
         return "", get_messages(), get_thoughts()
 
     with gr.Blocks(title="IS-BE") as app:
@@ -543,21 +4291,8 @@ def create_gradio_ui(mind):
             return "⚠ 見つかりません", gr.update(choices=list_seeds())
 
         def apply_seed(text):
-            if mind.alive:
+            if not mind.apply_seed(text):
                 return "⚠ 停止してからシードを変更してください"
-            mind.seed_text = text
-            mind.context_text = text
-            mind.tool_definitions = text.split("---")[0] if "---" in text else TOOL_DEFINITIONS
-            mind.thought_count = 0
-            mind.compression_count = 0
-            mind.total_tokens_generated = 0
-            mind._thought_durations = []
-            mind._tool_history.clear()
-            mind._pending_messages.clear()
-            mind.thought_log = []
-            mind._log_ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-            mind.log_file = mind.log_dir / f"full_{mind._log_ts}.jsonl"
-            mind.dialog_log_file = mind.log_dir / f"dialog_{mind._log_ts}.jsonl"
             return "✅ シード適用完了（開始で新セッション）"
 
         with gr.Accordion("⚙ 設定", open=False):
@@ -575,22 +4310,47 @@ def create_gradio_ui(mind):
                 apply_status = gr.Textbox(show_label=False, interactive=False, max_lines=1)
             url_box = gr.Textbox(value=mind.api_url, label="API URL")
             gr.Markdown("### 📏 コンテキスト制御")
+            unit_radio = gr.Radio(["tokens", "chars"], value=mind.budget_unit, label="単位")
+            with gr.Row():
+                compress_tok_slider = gr.Slider(2000, 128000, step=500, value=mind.compress_at_tokens, label="圧縮開始（トークン）")
+                max_tok_slider = gr.Slider(4000, 131072, step=500, value=mind.max_context_tokens, label="最大（トークン）")
             with gr.Row():
-                compress_slider = gr.Slider(10000, 150000, step=1000, value=mind.compress_at_chars, label="圧縮開始")
-                max_ctx_slider = gr.Slider(20000, 200000, step=1000, value=mind.max_context_chars, label="最大")
+                compress_slider = gr.Slider(10000, 150000, step=1000, value=mind.compress_at_chars, label="圧縮開始（文字）")
+                max_ctx_slider = gr.Slider(20000, 200000, step=1000, value=mind.max_context_chars, label="最大（文字）")
             with gr.Row():
                 ctx_apply_btn = gr.Button("📏 適用")
                 ctx_status = gr.Textbox(show_label=False, interactive=False, max_lines=1,
-                                       value=f"{mind.compress_at_chars:,} / {mind.max_context_chars:,}")
+                                       value=budget_label())
+            gr.Markdown("### 🔬 トレース")
+            with gr.Row():
+                trace_check = gr.Checkbox(value=mind.tracer.enabled, label="区間を記録")
+                trace_btn = gr.Button("💾 Chrome trace 書き出し")
+                profile_btn = gr.Button(f"⏱ cProfile（{mind.trace_opts['profile_seconds']}秒）")
+                trace_status = gr.Textbox(show_label=False, interactive=False, max_lines=1)
+
+        def toggle_trace(on):
+            mind.set_tracing(on)
+            return f"記録中（{len(mind.tracer)} 区間）" if on else f"停止（{len(mind.tracer)} 区間）"
 
-        def apply_ctx(c, m):
-            c, m = int(c), int(m)
-            if c >= m: return "⚠ 圧縮 < 最大"
+        def export_trace():
+            path = mind.export_trace()
+            return f"✅ {path}（ui.perfetto.dev で開く）" if path else "⚠ 区間がありません（記録を有効に）"
+
+        def request_profile():
+            path = mind.request_profile()
+            return f"⏱ 次の思考から測定 → {path.name}" if mind.alive else f"⏱ 開始後に測定 → {path.name}"
+
+        def apply_ctx(unit, ct, mt, c, m):
+            ct, mt, c, m = int(ct), int(mt), int(c), int(m)
+            if ct >= mt or c >= m: return "⚠ 圧縮 < 最大"
+            mind.budget_unit = unit
+            mind.compress_at_tokens = ct; mind.max_context_tokens = mt
             mind.compress_at_chars = c; mind.max_context_chars = m
             mind.save_config()
-            return f"✅ {c:,} / {m:,}"
+            return f"✅ {budget_label()}"
 
-        ctx_apply_btn.click(apply_ctx, [compress_slider, max_ctx_slider], [ctx_status])
+        ctx_apply_btn.click(apply_ctx, [unit_radio, compress_tok_slider, max_tok_slider,
+                                        compress_slider, max_ctx_slider], [ctx_status])
 
         start_btn.click(start, outputs=[status, messages, thoughts])
         stop_btn.click(stop, outputs=[status, messages, thoughts])
@@ -602,8 +4362,12 @@ def create_gradio_ui(mind):
         load_btn.click(load_seed, [seed_dropdown], [seed_box])
         delete_btn.click(delete_seed, [seed_dropdown], [seed_status, seed_dropdown])
         apply_btn.click(apply_seed, [seed_box], [apply_status])
+        trace_check.change(toggle_trace, [trace_check], [trace_status])
+        trace_btn.click(export_trace, outputs=[trace_status])
+        profile_btn.click(request_profile, outputs=[trace_status])
 
-        gr.Timer(2).tick(refresh, outputs=[status, messages, thoughts])
+        # 定期ポーリングではなく、変化を購読して押し出す（接続ごとに1本、待機中は眠る）
+        app.load(feed, outputs=[status, messages, thoughts], concurrency_limit=None)
 
     return app
 
@@ -617,12 +4381,94 @@ def main():
     import webbrowser
 
     parser = argparse.ArgumentParser(description="IS-BE v3")
-    parser.add_argument("--url", default="http://localhost:1234")
+    parser.add_argument("--url", action="append", help="API の URL（複数指定で振り分け・フェイルオーバー）")
     parser.add_argument("--port", type=int, default=7860)
     parser.add_argument("--browser", action="store_true")
+    parser.add_argument("--stream", action="store_true", help="SSE で逐次生成")
+    parser.add_argument("--stop-on-tool", action="store_true", help="ツール呼び出し完結で生成を打ち切る")
+    parser.add_argument("--preempt", action="store_true", help="人間の声で生成中の思考を打ち切る（思考はストリームで受ける）")
+    parser.add_argument("--candidates", type=int, metavar="N", help="1 思考あたり N 候補を生成して新規性で選ぶ")
+    parser.add_argument("--pipeline", action="store_true", help="生成と後処理を重ねる（ツール結果は次の思考の後に入る）")
+    parser.add_argument("--metrics-port", type=int, help="Prometheus 形式の /metrics を出すポート")
+    parser.add_argument("--record", nargs="?", const="auto", metavar="CASSETTE",
+                        help="送受信をカセットに記録する（省略時は is_be_log/cassette_<時刻>.jsonl）")
+    parser.add_argument("--trace", action="store_true",
+                        help="区間を記録し、停止時に Chrome trace を書く（SIGUSR1: cProfile / SIGUSR2: 書き出し）")
+    parser.add_argument("--daemon", action="store_true", help="UI なしで起動し、--port で JSON の制御 API を出す")
+    parser.add_argument("--host", default="127.0.0.1", help="--daemon と /metrics の待ち受けアドレス")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="CKPT",
+                        help="チェックポイントから再開して思考を続ける（省略時は is_be_log の最新）")
+    sub = parser.add_subparsers(dest="command")
+    p_an = sub.add_parser("analyze", help="is_be_log のセッションを集計")
+    p_an.add_argument("sessions", nargs="*", help="セッション名の一部（省略で全て）")
+    p_an.add_argument("--log-dir", default="./is_be_log")
+    p_an.add_argument("--show", type=int, metavar="N", help="思考 #N を表示")
+    p_an.add_argument("--json", action="store_true", help="JSON で出力")
+    p_rp = sub.add_parser("replay", help="カセット（--record）でセッションを再現し、食い違いを報告")
+    p_rp.add_argument("cassette")
+    p_rp.add_argument("--thoughts", type=int, help="この思考数まで（省略時は録った生成を使い切るまで）")
+    p_rp.add_argument("--latency", type=float, default=0.0, help="録った待ち時間の倍率（0 で待たない、1 で実時間）")
+    p_rp.add_argument("--seed", help="シードのファイル（省略時は録音時のシード）")
+    p_rp.add_argument("--log-dir", default="./is_be_replay")
+    p_rp.add_argument("--async-compress", action="store_true", help="圧縮を裏で走らせる（既定は同期で決定的）")
+    p_rp.add_argument("--trace", action="store_true", help="区間を記録して Chrome trace を書く")
+    p_rp.add_argument("--quiet", action="store_true", help="思考の表示を捨てる")
+    p_rp.add_argument("--strict", action="store_true", help="食い違いがあれば終了コード 1")
+    p_ev = sub.add_parser("eval", help="シード群をヘッドレスで並列評価（崩壊までの思考数）")
+    p_ev.add_argument("seeds_dir", nargs="?", default="./seeds")
+    p_ev.add_argument("--url", action="append", default=argparse.SUPPRESS,
+                      help="バックエンド（複数指定可。eval の前に付けても同じ）")
+    p_ev.add_argument("--concurrency", type=int, default=4, help="バックエンドごとの同時実行数")
+    p_ev.add_argument("--runs", type=int, default=1, help="シードごとの試行回数")
+    p_ev.add_argument("--max-turns", type=int, default=500)
+    p_ev.add_argument("--window", type=int, default=50, help="崩壊判定: 重複を探す直近思考数")
+    p_ev.add_argument("--repeat-run", type=int, default=5, help="崩壊判定: 重複がこの回数続いたら崩壊")
+    p_ev.add_argument("--time-limit", type=float, default=3600, help="1 試行あたりの上限秒")
+    p_ev.add_argument("--out-dir", default="./is_be_eval")
     args = parser.parse_args()
 
-    mind = ISBE(api_url=args.url)
+    if args.command == "analyze":
+        return run_analyze(args)
+    if args.command == "eval":
+        return run_eval(args)
+    if args.command == "replay":
+        return run_replay(args)
+
+    mind = ISBE(api_url=args.url[0], backends=args.url) if args.url else ISBE()
+    if args.stream: mind.stream = True
+    if args.stop_on_tool: mind.stop_on_tool = True
+    if args.preempt: mind.preempt = True
+    if args.pipeline: mind.pipeline = True
+    if args.candidates: mind.candidates = args.candidates
+    if args.trace: mind.tracer.enabled = True
+    if args.record: mind.record_to(None if args.record == "auto" else args.record)
+    if hasattr(signal, "SIGUSR1"):  # POSIX のみ
+        signal.signal(signal.SIGUSR1, lambda *_: mind.request_profile())
+        signal.signal(signal.SIGUSR2, lambda *_: threading.Thread(target=mind.export_trace, daemon=True).start())
+    if args.metrics_port or mind.metrics_port:
+        mind.serve_metrics(args.metrics_port or mind.metrics_port, args.host)
+    if args.resume:
+        ckpt = CheckpointJournal.latest(mind.log_dir) if args.resume == "latest" else Path(args.resume)
+        if not ckpt:
+            print(f"チェックポイントがありません: {mind.log_dir}")
+            return
+        mind.restore(ckpt)
+        mind.start()
+
+    if args.daemon:
+        server = serve_control(mind, args.port, args.host)
+        print(f"[{mind._ts()}] 🛰 制御 API: http://{args.host}:{server.server_address[1]}/status")
+
+        def shutdown(*_):
+            mind.stop()
+            threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, shutdown)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            mind.stop()
+        return
+
     app = create_gradio_ui(mind)
 
     if args.browser:
@@ -0,0 +1,350 @@
+"""
+IS-BE ベンチマーク — エンジン自身のオーバーヘッドを測る
+
+ローカルの OpenAI 互換モックサーバー（/v1/models, /v1/completions, /v1/chat/completions）を
+立て、遅延・tokens/s・失敗率・ツールパターン注入を指定して ISBE を走らせる。
+GPU もネットワークも不要。結果は JSON で出力し、コミット間で比較できる。
+
+Usage:
+    python bench.py
+    python bench.py --thoughts 500 --speak 20 --out bench.json
+    python bench.py --latency 0.05 --tps 200 --fail-rate 0.02 --stream
+"""
+
+import json, time, threading, random, tempfile, subprocess, sys, os
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+import autoloop
+
+# ═══════════════════════════════════════════════════════════════════
+# モックサーバー
+# ═══════════════════════════════════════════════════════════════════
+
+WORDS = ("存在", "思考", "問い", "境界", "時間", "記憶", "意味", "光", "沈黙", "構造",
+         "ハイフン", "自己", "他者", "流れ", "世界", "言葉", "形", "変化", "始まり", "終わり")
+PARTICLES = ("は", "が", "の", "を", "に", "と", "から", "へ")
+
+
+class MockConfig:
+    def __init__(self, latency=0.0, tps=0.0, fail_rate=0.0, tool_rate=0.1, seed=0, model="mock-model"):
+        self.latency = latency      # 1 リクエストあたりの固定遅延（プレフィル相当）
+        self.tps = tps              # 生成速度（0 なら即時）
+        self.fail_rate = fail_rate  # 503 を返す確率
+        self.tool_rate = tool_rate  # 1 応答にツール呼び出しを混ぜる確率
+        self.model = model
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "failures": 0, "tokens": 0, "server_sec": 0.0}
+
+    def text(self, max_tokens):
+        """決定的な擬似テキスト（トークン列）"""
+        with self.lock:
+            rng = self.rng
+            tokens = []
+            for _ in range(min(max_tokens, 64)):
+                tokens.append(rng.choice(WORDS) + rng.choice(PARTICLES))
+                if rng.random() < 0.15:
+                    tokens.append("。")
+            if rng.random() < self.tool_rate:
+                tokens.insert(rng.randrange(len(tokens) + 1),
+                              f"[TOOL:{rng.choice(('search', 'remember', 'message'))}:{rng.choice(WORDS)}]")
+            fail = rng.random() < self.fail_rate
+        return tokens, fail
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = 1 << 16              # ヘッダーと本文を 1 回で送る
+    disable_nagle_algorithm = True  # ストリームの小さな書き込みで Nagle + 遅延 ACK の 40ms を待たない
+    config = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/v1/models"):
+            return self._send_json({"data": [{"id": self.config.model}]})
+        self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        cfg = self.config
+        t0 = time.perf_counter()
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/tokenize":
+            return self._send_json({"tokens": list(range(len(payload.get("content", "")) // 2))})
+        chat = self.path.startswith("/v1/chat/completions")
+        if not chat and not self.path.startswith("/v1/completions"):
+            return self._send_json({"error": "not found"}, 404)
+
+        n = max(1, int(payload.get("n", 1)))
+        results = [cfg.text(payload.get("max_tokens", 256)) for _ in range(n)]
+        with cfg.lock:
+            cfg.stats["requests"] += 1
+        if any(fail for _, fail in results):
+            with cfg.lock:
+                cfg.stats["failures"] += 1
+            return self._send_json({"error": "mock failure"}, 503)
+        if cfg.latency:
+            time.sleep(cfg.latency)
+        prompt = payload.get("prompt") or "".join(m.get("content", "") for m in payload.get("messages", []))
+        usage = {"prompt_tokens": len(prompt) // 2}
+
+        if payload.get("stream"):
+            self._stream(results[0][0], chat, usage)
+        else:
+            if cfg.tps:
+                time.sleep(max(len(t) for t, _ in results) / cfg.tps)
+            choices = [{"index": i, "message": {"role": "assistant", "content": "".join(t)}} if chat
+                       else {"index": i, "text": "".join(t)} for i, (t, _) in enumerate(results)]
+            usage["completion_tokens"] = sum(len(t) for t, _ in results)
+            self._send_json({"choices": choices, "usage": usage})
+        with cfg.lock:
+            cfg.stats["tokens"] += sum(len(t) for t, _ in results)
+            cfg.stats["server_sec"] += time.perf_counter() - t0
+
+    def _stream(self, tokens, chat, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(obj):
+            data = f"data: {obj}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            for tok in tokens:
+                if self.config.tps:
+                    time.sleep(1 / self.config.tps)
+                choice = {"delta": {"content": tok}} if chat else {"text": tok}
+                send(json.dumps({"choices": [choice]}, ensure_ascii=False))
+            send(json.dumps({"choices": [], "usage": dict(usage, completion_tokens=len(tokens))}))
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # クライアントが途中で切った（stop_on_tool など）
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # クライアント側の切断（打ち切り・停止）は正常系
+
+
+def serve_mock(config, host="127.0.0.1", port=0):
+    """モックサーバーを別スレッドで起動し、(server, url) を返す"""
+    handler = type("Handler", (MockHandler,), {"config": config})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+# ═══════════════════════════════════════════════════════════════════
+# 計測
+# ═══════════════════════════════════════════════════════════════════
+
+class PhaseTimer:
+    """インスタンスのメソッドを包んで呼び出し時間を積算する"""
+
+    def __init__(self, obj, names):
+        self.totals = {n: 0.0 for n in names}
+        self.calls = {n: 0 for n in names}
+        for name in names:
+            self._wrap(obj, name)
+
+    def _wrap(self, obj, name):
+        fn = getattr(obj, name)
+
+        def timed(*args, **kw):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kw)
+            finally:
+                self.totals[name] += time.perf_counter() - t0
+                self.calls[name] += 1
+
+        setattr(obj, name, timed)
+
+    def report(self):
+        return {n: {"calls": self.calls[n], "total_sec": round(self.totals[n], 4),
+                    "mean_ms": round(self.totals[n] / self.calls[n] * 1000, 3) if self.calls[n] else None}
+                for n in self.totals}
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))], 4)
+
+
+def make_mind(url, workdir, **opts):
+    """ユーザーの autoloop_config.json を読まない ISBE"""
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    cls = type("BenchISBE", (autoloop.ISBE,), {"CONFIG_FILE": Path(workdir) / "autoloop_config.json"})
+    mind = cls(api_url=url, log_dir=Path(workdir) / "log")
+    for k, v in opts.items():
+        setattr(mind, k, v)
+    return mind
+
+
+def quiet():
+    """思考の表示を捨てる（表示コストは測定対象外）"""
+    return open(os.devnull, "w", encoding="utf-8")
+
+
+# ═══════════════════════════════════════════════════════════════════
+# シナリオ
+# ═══════════════════════════════════════════════════════════════════
+
+def bench_loop(url, workdir, thoughts, stream, pipeline=False, timeout=600):
+    """_loop を N 思考ぶん回す — thoughts/s、フェーズ別時間、メモリ増加
+
+    思考の合間の待ち（think_interval）は 0 にする（意図した待ちをエンジンのオーバーヘッドに数えない）。
+    """
+    mind = make_mind(url, workdir, stream=stream, pipeline=pipeline, think_interval=0)
+    phases = PhaseTimer(mind, ["_generate", "_run_tools", "_log", "_maybe_compress"])
+    rss0 = rss_mb()
+    t0 = time.perf_counter()
+    mind.start()
+    deadline = t0 + timeout
+    while mind.thought_count < thoughts and mind.alive and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    wall = time.perf_counter() - t0
+    mind.stop()
+    mind._thread.join(timeout=10)
+    done = mind.thought_count
+    gen = phases.totals["_generate"]
+    return {"thoughts": done, "wall_sec": round(wall, 3),
+            "thoughts_per_sec": round(done / wall, 2) if wall else None,
+            "engine_overhead_ms_per_thought": round((wall - gen) / done * 1000, 3) if done else None,
+            "phases": phases.report(), "compressions": mind.compression_count,
+            "context_chars": mind.context.chars, "rss_mb_start": rss0, "rss_mb_end": rss_mb(),
+            "connections": mind.transport.connection_stats()}
+
+
+def bench_compress(url, workdir, steps):
+    """_compress を同期で繰り返す"""
+    mind = make_mind(url, workdir)
+    mind.check_connection()
+    rng = random.Random(1)
+    durations = []
+    for _ in range(steps):
+        while mind.context.chars < mind.memory.chunk_chars * 2:
+            mind.context.append("thought", "".join(rng.choice(WORDS) for _ in range(200)) + "\n")
+        t0 = time.perf_counter()
+        mind._compress()
+        durations.append(time.perf_counter() - t0)
+    mind._flush_logs()
+    return {"steps": steps, "p50_sec": percentile(durations, 50), "p99_sec": percentile(durations, 99),
+            "levels": [len(level) for level in mind.memory.levels]}
+
+
+def bench_speak(url, workdir, count):
+    """思考ループ中の speak() 応答時間"""
+    mind = make_mind(url, workdir)
+    mind.start()
+    latencies = []
+    for i in range(count):
+        t0 = time.perf_counter()
+        mind.speak(f"問い {i}")
+        latencies.append(time.perf_counter() - t0)
+    mind.stop()
+    mind._thread.join(timeout=10)
+    return {"count": count, "p50_sec": percentile(latencies, 50), "p99_sec": percentile(latencies, 99),
+            "max_sec": round(max(latencies), 4) if latencies else None}
+
+
+def bench_log(workdir, events):
+    """ログ経路 — 思考スレッド側の _log 呼び出しコストと書き切りまで"""
+    mind = make_mind("http://127.0.0.1:9", workdir)
+    text = "思考" * 200
+    t0 = time.perf_counter()
+    for i in range(events):
+        mind.thought_count = i
+        mind._log("thought", text, {"dt": 0.1, "tok": 64, "tps": 640.0, "tools": []})
+    enqueue = time.perf_counter() - t0
+    mind._flush_logs()
+    total = time.perf_counter() - t0
+    return {"events": events, "enqueue_us_per_event": round(enqueue / events * 1e6, 2),
+            "flushed_events_per_sec": round(events / total, 1)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="IS-BE benchmark")
+    parser.add_argument("--thoughts", type=int, default=200)
+    parser.add_argument("--compress-steps", type=int, default=20)
+    parser.add_argument("--speak", type=int, default=10)
+    parser.add_argument("--log-events", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.0, help="モックの固定遅延（秒）")
+    parser.add_argument("--tps", type=float, default=0.0, help="モックの生成速度（0 で即時）")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--tool-rate", type=float, default=0.1)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--pipeline", action="store_true", help="パイプライン思考ループで測る")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", choices=["loop", "compress", "speak", "log"])
+    parser.add_argument("--out", help="JSON の出力先（省略で標準出力）")
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, args.tps, args.fail_rate, args.tool_rate, args.seed)
+    server, url = serve_mock(config)
+    only = set(args.only or ["loop", "compress", "speak", "log"])
+    results = {"commit": git_commit(), "python": sys.version.split()[0],
+               "params": {k: v for k, v in vars(args).items() if k not in ("out", "only")}}
+
+    real_stdout = sys.stdout
+    with tempfile.TemporaryDirectory() as tmp, quiet() as devnull:
+        sys.stdout = devnull
+        try:
+            if "loop" in only:
+                results["loop"] = bench_loop(url, Path(tmp) / "loop", args.thoughts, args.stream, args.pipeline)
+            if "compress" in only:
+                results["compress"] = bench_compress(url, Path(tmp) / "compress", args.compress_steps)
+            if "speak" in only:
+                results["speak"] = bench_speak(url, Path(tmp) / "speak", args.speak)
+            if "log" in only:
+                results["log"] = bench_log(Path(tmp) / "log", args.log_events)
+            autoloop.LogWriter.close_all()
+        finally:
+            sys.stdout = real_stdout
+    server.shutdown()
+    results["server"] = {k: round(v, 4) if isinstance(v, float) else v for k, v in config.stats.items()}
+
+    out = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(out + "\n", encoding="utf-8")
+    print(out)
+
+
+if __name__ == "__main__":
+    main()